@@ -0,0 +1,182 @@
+"""
+In-memory Google Sheets and a SQLite stand-in for the MySQL pool, for bench/run_bench.py.
+
+FakeClient mimics the slice of gspread both scripts use: service_account_from_dict
+/ open / open_by_url / worksheet, and on a worksheet batch_get, get, row_values,
+batch_update and row_count. SqlitePool answers get_connection() with
+connections that accept the scripts' MySQL upsert (%s placeholders and
+ON DUPLICATE KEY UPDATE are rewritten for SQLite).
+"""
+import re, time, sqlite3, threading
+
+
+def _a1_to_rc(ref):
+    """'B12' -> (12, 2); 'B' -> (None, 2); '12' -> (12, None). 1-based."""
+    m = re.match(r"^([A-Za-z]*)(\d*)$", ref)
+    letters, digits = m.group(1), m.group(2)
+    col = 0
+    for ch in letters.upper():
+        col = col * 26 + ord(ch) - 64
+    return (int(digits) if digits else None), (col or None)
+
+
+class FakeWorksheet:
+    def __init__(self, title, rows, ws_id=0, spreadsheet=None, latency=0.0):
+        self.title = title
+        self.rows = [list(r) for r in rows]  # row 1 = header
+        self.id = ws_id
+        self.spreadsheet = spreadsheet
+        self.latency = latency  # seconds per API call, to model Sheets round trips
+        self.updates = []       # (range, values) received by batch_update
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def row_count(self):
+        return len(self.rows)
+
+    def _api(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _range(self, a1):
+        a1 = a1.split("!")[-1]
+        start, _, end = a1.partition(":")
+        r1, c1 = _a1_to_rc(start)
+        r2, c2 = _a1_to_rc(end or start)
+        r1, r2 = r1 or 1, r2 or len(self.rows)
+        out = []
+        for r in range(r1, min(r2, len(self.rows)) + 1):
+            row = self.rows[r - 1]
+            cells = row[(c1 or 1) - 1:(c2 or len(row))]
+            while cells and cells[-1] == "":
+                cells.pop()
+            out.append(cells)
+        while out and not out[-1]:  # the API trims trailing empty rows
+            out.pop()
+        return out
+
+    def get(self, a1):
+        self._api()
+        return self._range(a1)
+
+    def batch_get(self, ranges):
+        self._api()
+        return [self._range(r) for r in ranges]
+
+    def row_values(self, n):
+        self._api()
+        return list(self.rows[n - 1]) if n <= len(self.rows) else []
+
+    def get_all_values(self):
+        self._api()
+        return [list(r) for r in self.rows]
+
+    def batch_update(self, data, **kwargs):
+        self._api()
+        with self._lock:
+            for d in data:
+                self.updates.append((d["range"], d["values"]))
+
+
+class FakeSpreadsheet:
+    def __init__(self, name, tabs):
+        self.id = f"bench-{name}"
+        self.lastUpdateTime = "bench"
+        self.tabs = {}
+        for k, (title, rows) in enumerate(tabs.items()):
+            self.tabs[title] = FakeWorksheet(title, rows, ws_id=k, spreadsheet=self)
+
+    def worksheet(self, title):
+        return self.tabs[title]
+
+
+class FakeClient:
+    """Spreadsheets are looked up by name for open() and by URL for open_by_url()."""
+
+    def __init__(self, spreadsheets):
+        self.spreadsheets = spreadsheets
+
+    def open(self, name):
+        return self.spreadsheets[name]
+
+    def open_by_url(self, url):
+        return self.spreadsheets[url]
+
+
+# ---------------- MySQL stand-in ---------------- #
+SCREENSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {table} (
+    symbol          TEXT NOT NULL,
+    timeframe       TEXT NOT NULL,
+    screenshot      BLOB,
+    chart_date      TEXT,
+    month_before    TEXT,
+    screenshot_hash TEXT,
+    created_at      TEXT,
+    UNIQUE (symbol, timeframe)
+)
+"""
+
+def mysql_to_sqlite(sql):
+    sql = sql.replace("%s", "?")
+    if "ON DUPLICATE KEY UPDATE" in sql:
+        head, _, tail = sql.partition("ON DUPLICATE KEY UPDATE")
+        tail = re.sub(r"VALUES\((\w+)\)", r"excluded.\1", tail)
+        sql = f"{head} ON CONFLICT (symbol, timeframe) DO UPDATE SET {tail}"
+    return sql
+
+
+class _Cursor:
+    def __init__(self, conn):
+        self.cur = conn.cursor()
+
+    def execute(self, sql, params=()):
+        self.cur.execute(mysql_to_sqlite(sql), params)
+
+    def executemany(self, sql, seq):
+        self.cur.executemany(mysql_to_sqlite(sql), list(seq))
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def close(self):
+        self.cur.close()
+
+
+class _Connection:
+    def __init__(self, path, latency):
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.latency = latency
+
+    def cursor(self):
+        if self.latency:
+            time.sleep(self.latency)
+        return _Cursor(self.conn)
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class SqlitePool:
+    """get_connection() like mysql.connector's pool; latency models the network round trip."""
+
+    def __init__(self, path, table, latency=0.0):
+        self.path = path
+        self.latency = latency
+        c = sqlite3.connect(path)
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute(SCREENSHOT_SCHEMA.format(table=table))
+        c.commit()
+        c.close()
+
+    def get_connection(self):
+        return _Connection(self.path, self.latency)
@@ -0,0 +1,173 @@
+"""
+Local stand-in for TradingView chart pages, used by bench/run_bench.py.
+
+Serves /chart/?symbol=X with the DOM hooks both scrapers rely on:
+- a chart-container holding the legend items and their valueValue cells;
+- a loader while the chart "renders"; the main series values show up halfway
+  through the render delay and the indicator values at the end;
+- an Alt+G "go to date" input; Enter re-renders, as after a date jump or an
+  interval switch;
+- the chart-markup-table used for cropping, and a canvas that differs per symbol.
+
+    python bench/fixture_server.py --port 8765 --render-ms 1500 --jitter-ms 500
+
+Chrome resolves every *.localhost name to the loopback address, so the pages
+can be served as http://tradingview.com.localhost:PORT/... and pass the
+scripts' "tradingview.com" URL checks.
+"""
+import sys, time, zlib, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+HOST_ALIAS = "tradingview.com.localhost"
+
+PAGE = """<!doctype html>
+<html><head><meta charset="utf-8"><title>{symbol} chart (bench)</title>
+<style>
+  body {{ margin: 0; font: 12px sans-serif; background: #fff; }}
+  .chart-container {{ position: relative; width: 1400px; height: 760px; }}
+  .legend {{ position: absolute; left: 8px; top: 6px; z-index: 2; }}
+  .valueItem {{ display: inline-block; margin-right: 6px; }}
+  .loader {{ position: absolute; left: 50%; top: 40%; width: 24px; height: 24px; border: 3px solid #999; }}
+  .query {{ position: absolute; left: 40%; top: 20%; z-index: 3; display: none; }}
+  table.chart-markup-table {{ border-collapse: collapse; }}
+  table.chart-markup-table td {{ padding: 0; }}
+</style></head>
+<body>
+<div class="chart-container">
+  <div class="legend"></div>
+  <div class="loader"></div>
+  <input class="query" type="text">
+  <table class="chart-markup-table">
+    <tr><td><canvas id="price" width="1400" height="560"></canvas></td></tr>
+    <tr><td><canvas id="pane" width="1400" height="200"></canvas></td></tr>
+  </table>
+</div>
+<script>
+window.user = {{username: "bench"}};
+const RENDER_MS = {render_ms}, JITTER_MS = {jitter_ms}, SEED = {seed};
+const MAIN = {main}, INDICATORS = {indicators};
+const legend = document.querySelector(".legend");
+const loader = document.querySelector(".loader");
+const input = document.querySelector(".query");
+
+function item(title, values) {{
+  return '<div data-name="legend-source-item"><div data-name="legend-source-title">' + title +
+    '</div><div class="valuesWrapper">' + values.map(v =>
+      '<div class="valueItem"><div class="valueTitle-bench">' + v[0] + '</div>' +
+      '<div class="valueValue-l31H9iuA">' + v[1] + '</div></div>').join("") + '</div></div>';
+}}
+function draw(id, h, frac, salt) {{
+  const c = document.getElementById(id).getContext("2d");
+  c.clearRect(0, 0, 1400, h);
+  let x = SEED + salt;
+  for (let i = 0; i < Math.floor(140 * frac); i++) {{
+    x = (x * 1103515245 + 12345) % 2147483648;
+    const v = x % (h - 20);
+    c.fillStyle = i % 2 ? "#26a69a" : "#ef5350";
+    c.fillRect(i * 10, h - 10 - v, 7, v);
+  }}
+}}
+let renders = 0;
+function render() {{
+  const n = ++renders;
+  loader.style.display = "block";
+  legend.innerHTML = "";
+  const d = RENDER_MS + Math.random() * JITTER_MS;
+  setTimeout(() => {{ if (n !== renders) return;
+    legend.innerHTML = item("{symbol}", MAIN); draw("price", 560, 1, n); }}, d / 2);
+  setTimeout(() => {{ if (n !== renders) return;
+    legend.innerHTML = item("{symbol}", MAIN) + INDICATORS.map(i => item(i[0], i[1])).join("");
+    draw("pane", 200, 1, n + 7); loader.style.display = "none"; }}, d);
+}}
+document.addEventListener("keydown", e => {{
+  if (e.altKey && (e.key === "g" || e.key === "G")) {{
+    input.style.display = "block"; input.focus(); e.preventDefault();
+  }} else if (e.key === "Enter") {{
+    input.style.display = "none"; input.value = ""; render();
+  }}
+}});
+render();
+</script>
+</body></html>
+"""
+
+
+def symbol_values(symbol):
+    """Deterministic legend values: 5 main-series cells + 3 indicators x 3 cells = 14."""
+    seed = zlib.crc32(symbol.encode())
+    base = 10 + seed % 990
+    main = [["O", f"{base:.2f}"], ["H", f"{base * 1.02:.2f}"], ["L", f"{base * 0.98:.2f}"],
+            ["C", f"{base * 1.01:.2f}"], ["", f"+{seed % 7}.{seed % 100:02d}%"]]
+    indicators = [
+        ["RSI 14", [["", f"{30 + seed % 40}.{seed % 10}"], ["", "70.00"], ["", "30.00"]]],
+        ["MACD 12 26", [["", f"{(seed % 200) / 100:.2f}"], ["", f"{(seed % 150) / 100:.2f}"], ["", f"{(seed % 50) / 100:.2f}"]]],
+        ["Vol", [["", f"{seed % 900}.{seed % 10}K"], ["", f"{seed % 700}.{seed % 10}K"], ["", "1"]]],
+    ]
+    return seed, main, indicators
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    render_ms = 1500
+    jitter_ms = 500
+    net_ms = 0
+
+    def do_GET(self):
+        u = urlparse(self.path)
+        if self.net_ms:
+            time.sleep(self.net_ms / 1000.0)
+        if u.path.startswith("/chart"):
+            symbol = (parse_qs(u.query).get("symbol") or ["BENCH"])[0]
+            seed, main, indicators = symbol_values(symbol)
+            body = PAGE.format(symbol=symbol, seed=seed % 100000, render_ms=self.render_ms, jitter_ms=self.jitter_ms,
+                               main=repr(main).replace("'", '"'), indicators=repr(indicators).replace("'", '"'))
+            self._send(200, body.encode())
+        elif u.path in ("/", "/favicon.ico"):
+            self._send(200, b"<!doctype html><title>bench</title>ok")
+        else:
+            self._send(404, b"not found")
+
+    def _send(self, code, body):
+        self.send_response(code)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Timing-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def start_server(port=0, render_ms=1500, jitter_ms=500, net_ms=0):
+    """Starts the fixture server on a daemon thread; returns (server, base_url)."""
+    handler = type("Handler", (FixtureHandler,), {"render_ms": render_ms, "jitter_ms": jitter_ms, "net_ms": net_ms})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fixture-server", daemon=True).start()
+    return server, f"http://{HOST_ALIAS}:{server.server_address[1]}"
+
+
+def chart_url(base_url, symbol):
+    return f"{base_url}/chart/?symbol={symbol}"
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--render-ms", type=int, default=1500)
+    ap.add_argument("--jitter-ms", type=int, default=500)
+    ap.add_argument("--net-ms", type=int, default=0)
+    args = ap.parse_args(argv)
+    server, base = start_server(args.port, args.render_ms, args.jitter_ms, args.net_ms)
+    print(f"✅ Fixture server on {base} (e.g. {chart_url(base, 'AAPL')})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,258 @@
+"""
+Offline benchmark: runs run_scraper.py and/or nextbagger-review.py end to end against
+the local chart fixture (bench/fixture_server.py), in-memory Google Sheets and a
+SQLite stand-in for MySQL (bench/fakes.py), for N symbols x M workers.
+
+    python bench/run_bench.py --script both --symbols 30 --workers 1,2,4 --render-ms 1500
+    python bench/run_bench.py --script nextbagger --workers 4,8 --exec-mode process
+    python bench/run_bench.py --script nextbagger --workers 4 --env ADAPTIVE_THREADS=1 --env ADAPT_MAX_LOAD=1.5
+
+Needs Chrome/Chromium and the scripts' Python dependencies, but no TradingView,
+Google or MySQL access. Every configuration runs in its own subprocess (the
+scripts read their config at import time); its log goes to --out-dir and the
+report lists rows/min, peak RSS of the process tree (Python + chromedriver +
+Chrome) and p50/p95 per stage from tv_metrics. The fixture tabs have blank-row gaps
+and duplicate headers like the real ones; a run that doesn't write exactly --symbols
+distinct symbols is flagged and makes the bench exit non-zero.
+"""
+import os, sys, json, time, shutil, argparse, threading, subprocess, importlib.util
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [BENCH_DIR, REPO_DIR]
+
+import fakes
+import fixture_server
+from tv_browser import process_tree_rss_mb
+
+SCRIPTS = ("run_scraper", "nextbagger")
+
+
+# ---------------- CHILD: one configuration ---------------- #
+class RssSampler:
+    def __init__(self, interval=0.5):
+        self.peak_mb = 0.0
+        self.interval = interval
+        self._stop = threading.Event()
+        self._t = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_mb = max(self.peak_mb, process_tree_rss_mb(os.getpid()) or 0.0)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._t.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._t.join(timeout=2)
+
+
+def symbols(n):
+    return [f"BENCH{k:04d}" for k in range(n)]
+
+
+GAP_EVERY = 7  # a blank row after every 7th symbol (two after every 21st), like the real tabs
+
+
+def with_gaps(rows):
+    """Data rows with blank rows in between; the API returns these as [] inside a range."""
+    out = []
+    for k, row in enumerate(rows, 1):
+        out.append(row)
+        if k % GAP_EVERY == 0 and k < len(rows):
+            out += [[""] * len(row)] * (2 if k % (3 * GAP_EVERY) == 0 else 1)
+    return out
+
+
+def run_scraper_child(args, work):
+    # duplicate header; blank rows in Sheet1 are scraped as empty rows but must not count as symbols
+    source = [["Symbol", "Symbol", "", "URL"]] + with_gaps([[s, "", "", fixture_server.chart_url(args.base_url, s)]
+                                                          for s in symbols(args.symbols)])
+    os.environ.update({
+        "START_INDEX": "0", "END_INDEX": str(len(source) - 2),
+        "SCRAPE_WORKERS": str(args.workers), "MAX_REQUESTS_PER_MIN": "0",
+        "SOURCE_CACHE_DIR": "", "PROFILE_DIR": "", "GSPREAD_CREDENTIALS": "{}",
+        "RESULT_STORE": os.path.join(work, "results.sqlite"),
+        "MANIFEST_FILE": os.path.join(work, "manifest.json"),
+        "METRICS_FILE": os.path.join(work, "metrics.jsonl"),
+    })
+    import run_scraper as rs
+
+    stock = fakes.FakeSpreadsheet("stock", {"Sheet1": source})
+    dest = fakes.FakeSpreadsheet("mv2", {"Sheet5": [[""] * 16]})
+    for ss in (stock, dest):
+        for ws in ss.tabs.values():
+            ws.latency = args.sheet_latency
+    client = fakes.FakeClient({rs.STOCK_LIST_URL: stock, rs.NEW_MV2_URL: dest})
+    rs.gspread.service_account_from_dict = lambda creds: client
+
+    t0 = time.perf_counter()
+    with RssSampler() as rss:
+        rs.main()
+    elapsed = time.perf_counter() - t0
+    written = {}  # Sheet5 row -> symbol in column A
+    for rng, vals in dest.tabs["Sheet5"].updates:
+        first = fakes._a1_to_rc(rng.split(":")[0])[0]
+        written.update((first + k, v[0] if v else "") for k, v in enumerate(vals))
+    rows = len({sym for sym in written.values() if sym})
+    return elapsed, rows, rss.peak_mb, rs.metrics
+
+
+def nextbagger_child(args, work):
+    os.environ.update({
+        "MAX_THREADS": str(args.workers), "EXEC_MODE": args.exec_mode, "IMAGE_DEDUP": "0", "PROFILE_DIR": "",
+        "DATE_CACHE_DIR": "", "GSPREAD_CREDENTIALS": "{}", "DB_HOST": "bench",
+        "CHECKPOINT_FILE": os.path.join(work, "checkpoint.json"),
+        "METRICS_FILE": os.path.join(work, "metrics.jsonl"),
+    })
+    os.environ.pop("TRADINGVIEW_COOKIES", None)
+    spec = importlib.util.spec_from_file_location("nextbagger_review", os.path.join(REPO_DIR, "nextbagger-review.py"))
+    nb = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(nb)
+
+    syms = symbols(args.symbols)
+    # duplicate Symbol/Day headers must resolve to the first columns, whose values are the real ones
+    weekday = [["Symbol", "Day", "Symbol", "Day"]] + with_gaps(
+        [[s, fixture_server.chart_url(args.base_url, s), "DUP", "DUP"] for s in syms])
+    sheet15 = [["Symbol"] + [""] * 24 + ["Date"]] + with_gaps([[s] + [""] * 24 + ["2024-03-15"] for s in syms[::-1]])
+    client = fakes.FakeClient({
+        nb.SPREADSHEET_NAME: fakes.FakeSpreadsheet("stock", {nb.TAB_NAME: weekday}),
+        nb.DATE_SPREADSHEET_NAME: fakes.FakeSpreadsheet("dates", {nb.DATE_TAB_NAME: sheet15}),
+    })
+    for ss in client.spreadsheets.values():
+        for ws in ss.tabs.values():
+            ws.latency = args.sheet_latency
+    nb.gspread.service_account_from_dict = lambda creds: client
+
+    pool = fakes.SqlitePool(os.path.join(work, "screens.sqlite"), nb.TARGET_TABLE, latency=args.db_latency)
+
+    def init_db_pool(pool_size=None, diagnose=True):
+        nb.db_pool = pool  # EXEC_MODE=process: each worker opens its own SQLite connections
+        return True
+
+    nb.preflight_env_check = lambda: True
+    nb.init_db_pool = init_db_pool
+    nb.db_network_diagnostics = lambda: None  # EXEC_MODE=process: the parent only probes the DB
+    nb.direct_connect_test = lambda: True
+    nb.cookie_login = lambda d: None  # the fixture needs no login (and must not reach tradingview.com)
+
+    t0 = time.perf_counter()
+    with RssSampler() as rss:
+        nb.main()
+    elapsed = time.perf_counter() - t0
+    c = pool.get_connection()
+    cur = c.cursor()
+    cur.execute(f"SELECT COUNT(DISTINCT symbol) FROM {nb.TARGET_TABLE}")
+    rows = cur.fetchone()[0]
+    c.close()
+    return elapsed, rows, rss.peak_mb, nb.metrics
+
+
+def child(args):
+    os.environ.update(kv.split("=", 1) for kv in args.env)
+    work = os.path.abspath(args.work_dir)
+    os.makedirs(work, exist_ok=True)
+    os.chdir(work)
+    run = run_scraper_child if args.script == "run_scraper" else nextbagger_child
+    elapsed, rows, peak_mb, metrics = run(args, work)
+    stages = {}
+    for stage in sorted(metrics.samples):
+        n, p50, p95, p99, mx, _ = metrics.stats(stage)
+        stages[stage] = {"n": n, "p50": p50, "p95": p95, "p99": p99, "max": mx}
+    result = {"script": args.script, "symbols": args.symbols, "workers": args.workers,
+              "elapsed_s": elapsed, "rows": rows, "rows_per_min": rows / elapsed * 60 if elapsed else 0.0,
+              "peak_rss_mb": peak_mb, "stages": stages}
+    with open(args.result, "w") as f:
+        json.dump(result, f)
+    return 0
+
+
+# ---------------- PARENT: matrix + report ---------------- #
+def report(results):
+    print("\n📊 BENCH RESULTS")
+    print(f"{'script':<12} {'N':>4} {'M':>3} {'rows':>5} {'rows/min':>9} {'secs':>7} {'peak RSS':>9}  per-symbol p50/p95")
+    for r in results:
+        tot = r["stages"].get("symbol_total", {})
+        print(f"{r['script']:<12} {r['symbols']:>4} {r['workers']:>3} {r['rows']:>5} {r['rows_per_min']:>9.1f} "
+              f"{r['elapsed_s']:>7.1f} {r['peak_rss_mb']:>7.0f}MB  {tot.get('p50', 0):.2f}s/{tot.get('p95', 0):.2f}s"
+              + ("" if r["rows"] == r["symbols"] else f"  ❌ expected {r['symbols']} symbols written"))
+    for r in results:
+        print(f"\n⏱️ {r['script']} N={r['symbols']} M={r['workers']}")
+        for stage, s in r["stages"].items():
+            print(f"   {stage:<16} n={s['n']:<5} p50={s['p50']:.3f}s p95={s['p95']:.3f}s max={s['max']:.3f}s")
+
+
+def parent(args):
+    scripts = SCRIPTS if args.script == "both" else (args.script,)
+    workers = [int(w) for w in str(args.workers).split(",") if w.strip()]
+    os.makedirs(args.out_dir, exist_ok=True)
+    server, base_url = fixture_server.start_server(0, args.render_ms, args.jitter_ms, args.net_ms)
+    print(f"✅ Fixture server {base_url} (render {args.render_ms}±{args.jitter_ms}ms, net {args.net_ms}ms)")
+
+    results = []
+    try:
+        for script in scripts:
+            for m in workers:
+                tag = f"{script}_n{args.symbols}_m{m}"
+                work = os.path.abspath(os.path.join(args.out_dir, tag))
+                result = os.path.join(work, "result.json")
+                shutil.rmtree(work, ignore_errors=True)  # no resume from an earlier run's store/checkpoint
+                os.makedirs(work, exist_ok=True)
+                cmd = [sys.executable, os.path.abspath(__file__), "--child", "--script", script,
+                       "--symbols", str(args.symbols), "--workers", str(m), "--base-url", base_url,
+                       "--work-dir", work, "--result", result,
+                       "--sheet-latency", str(args.sheet_latency), "--db-latency", str(args.db_latency),
+                       "--exec-mode", args.exec_mode] + [a for kv in args.env for a in ("--env", kv)]
+                print(f"▶️ {tag} (log: {os.path.join(work, 'run.log')})")
+                with open(os.path.join(work, "run.log"), "w") as log:
+                    code = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, timeout=args.timeout)
+                if code != 0 or not os.path.exists(result):
+                    print(f"❌ {tag} failed (exit {code}), see its run.log")
+                    continue
+                with open(result) as f:
+                    results.append(json.load(f))
+    finally:
+        server.shutdown()
+
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+    # a run that skipped or duplicated symbols is a bug, not a slow configuration
+    return 0 if results and all(r["rows"] == r["symbols"] for r in results) else 1
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--script", choices=SCRIPTS + ("both",), default="both")
+    ap.add_argument("--symbols", type=int, default=20, help="N symbols per run")
+    ap.add_argument("--workers", default="1,2", help="comma list of M workers to compare")
+    ap.add_argument("--render-ms", type=int, default=1500, help="fixture render delay")
+    ap.add_argument("--jitter-ms", type=int, default=500, help="extra random render delay")
+    ap.add_argument("--net-ms", type=int, default=0, help="fixture response delay")
+    ap.add_argument("--sheet-latency", type=float, default=0.2, help="seconds per fake Sheets call")
+    ap.add_argument("--db-latency", type=float, default=0.05, help="seconds per fake DB round trip")
+    ap.add_argument("--exec-mode", choices=("thread", "process"), default="thread",
+                    help="nextbagger EXEC_MODE: M threads or M worker processes")
+    ap.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                    help="extra script setting for every run (repeatable), e.g. ADAPTIVE_THREADS=1")
+    ap.add_argument("--timeout", type=float, default=1800, help="per-configuration limit in seconds")
+    ap.add_argument("--out-dir", default="bench_out")
+    ap.add_argument("--json", default="", help="also write all results to this file")
+    # internal: one configuration in a subprocess
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    ap.add_argument("--base-url", help=argparse.SUPPRESS)
+    ap.add_argument("--work-dir", help=argparse.SUPPRESS)
+    ap.add_argument("--result", help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+    if args.child:
+        args.workers = int(args.workers)
+        return child(args)
+    return parent(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,8 @@
+-- Enables IMAGE_DEDUP=1 in nextbagger-review.py: the md5 of the raw screenshot is stored next to it,
+-- and a chart whose new screenshot hashes the same for the same chart_date skips its upsert.
+-- nextbagger-review.py only checks for this column (information_schema) and never alters the table;
+-- run this once by hand, outside the scraper's schedule (it rewrites the table on older MySQL versions).
+-- Lookups go through the existing (symbol, timeframe) unique key, so no extra index is needed.
+
+ALTER TABLE next_bagger_review_screenshot
+    ADD COLUMN screenshot_hash CHAR(32) NULL;
@@ -1,5 +1,5 @@
-import os, time, json, gspread, concurrent.futures, re, socket, hashlib
-import pandas as pd
+import os, io, time, json, gspread, concurrent.futures, re, socket, hashlib, queue, signal, functools
+import multiprocessing
 import mysql.connector
 from mysql.connector import pooling
 from selenium import webdriver
@@ -12,6 +12,17 @@ from selenium.webdriver.common.action_chains import ActionChains
 from datetime import datetime
 import threading
 
+try:
+    from PIL import Image  # optional: only needed for re-encoding / cropping
+except ImportError:
+    Image = None
+
+from tv_browser import (SessionProfile, inject_cookies, wait_chart_rendered,
+                        block_urls_from_env, install_resource_filter, page_traffic, mem_available_mb,
+                        driver_root_pid, driver_rss_mb, kill_orphan_browsers)
+from sheet_cache import get_ranges_cached
+from tv_metrics import Metrics
+
 # ---------------- CONFIG ---------------- #
 SPREADSHEET_NAME = "Stock List"
 TAB_NAME = "Weekday"
@@ -21,27 +32,95 @@ DATE_SPREADSHEET_NAME = "MV2 for SQL"
 DATE_TAB_NAME = "Sheet15"
 DATE_COL_LETTER = "Z"
 DATE_SYMBOL_COL = "A"
+DATE_CACHE_DIR = os.getenv("DATE_CACHE_DIR", ".sheet_cache")  # "" disables the local snapshot
+DATE_CACHE_TTL = float(os.getenv("DATE_CACHE_TTL", "0"))      # fallback when the sheet revision can't be read
 
 # ✅ target table
 TARGET_TABLE = "next_bagger_review_screenshot"  # IMPORTANT
 
 MAX_THREADS = int(os.getenv("MAX_THREADS", "2"))
 
+# "thread": MAX_THREADS Selenium threads in this process. "process": MAX_THREADS forked worker processes,
+# each with one driver, its own DB pool, DB writer and encoder; the parent streams rows to them and owns
+# the checkpoint, so hashing/encoding and the Selenium client no longer share one GIL. Linux only (fork).
+EXEC_MODE = os.getenv("EXEC_MODE", "thread").strip().lower()
+
+# Adaptive concurrency (AIMD): MAX_THREADS threads exist, but only `limit` of them work at a time.
+# +1 while rows stay fast and the runner has headroom; halved on timeouts / low memory / CPU overload.
+ADAPTIVE_THREADS   = os.getenv("ADAPTIVE_THREADS", "0") == "1"
+MIN_THREADS        = max(1, min(MAX_THREADS, int(os.getenv("MIN_THREADS", "1"))))
+START_THREADS      = max(MIN_THREADS, min(MAX_THREADS, int(os.getenv("START_THREADS", str(MIN_THREADS)))))
+ADAPT_INTERVAL     = float(os.getenv("ADAPT_INTERVAL_SECS", "45"))
+ADAPT_MIN_ROWS     = int(os.getenv("ADAPT_MIN_ROWS", "4"))
+ADAPT_MAX_ERR_RATE = float(os.getenv("ADAPT_MAX_ERR_RATE", "0.2"))    # timeouts/errors per row in a window
+ADAPT_MIN_MEM_MB   = float(os.getenv("ADAPT_MIN_MEM_MB", "1500"))     # MemAvailable floor
+ADAPT_MAX_LOAD     = float(os.getenv("ADAPT_MAX_LOAD", "3.0"))        # 1-min loadavg per CPU (Chrome runs hot:
+                                                                      # tune with bench/run_bench.py --env)
+ADAPT_LAT_SLACK    = float(os.getenv("ADAPT_LAT_SLACK", "1.6"))       # p50 vs the (decaying) best p50
+ADAPT_BEST_DECAY   = float(os.getenv("ADAPT_BEST_DECAY", "1.1"))      # best p50 drifts up this much per window
+
 SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
 SHARD_STEP  = int(os.getenv("SHARD_STEP", "1"))
 
 CHECKPOINT_FILE = os.getenv("CHECKPOINT_FILE", "checkpoint_nextbagger.txt")
+CHECKPOINT_FSYNC_SECS = float(os.getenv("CHECKPOINT_FSYNC_SECS", "5"))
+
+# DB writer thread: screenshots are upserted in multi-row batches, one commit per batch
+DB_BATCH_SIZE      = int(os.getenv("DB_BATCH_SIZE", "8"))
+DB_BATCH_MAX_BYTES = int(os.getenv("DB_BATCH_MAX_BYTES", str(8 * 1024 * 1024)))  # stay under max_allowed_packet
+DB_FLUSH_SECS      = float(os.getenv("DB_FLUSH_SECS", "3"))
+
+# Image pipeline: "png" stores Chrome's PNG as-is, "png-opt" re-compresses it, "webp" re-encodes
+IMAGE_FORMAT        = os.getenv("IMAGE_FORMAT", "png").strip().lower()
+IMAGE_QUALITY       = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_CROP          = os.getenv("IMAGE_CROP", "0") == "1"  # crop to the main price pane
+IMAGE_CROP_SELECTOR = os.getenv("IMAGE_CROP_SELECTOR", ".chart-markup-table tr:first-child")
+IMAGE_DEDUP         = os.getenv("IMAGE_DEDUP", "0") == "1"  # skip the upsert when the stored hash matches;
+                                                             # needs migrations/next_bagger_screenshot_hash.sql
+
+# Timeframes captured per page load: the "day" URL is loaded once, then the interval is switched in-page
+TIMEFRAMES = [t.strip().lower() for t in os.getenv("TIMEFRAMES", "day").split(",") if t.strip()] or ["day"]
+TIMEFRAME_CODES = {"day": "1D", "week": "1W", "month": "1M"}  # other names are typed as-is (e.g. "240")
+TIMEFRAME_REJUMP = os.getenv("TIMEFRAME_REJUMP", "0") == "1"  # redo the Alt+G date jump after each switch
+
+# Pipeline: encoding + DB run off the Selenium threads; optionally preload the next chart in a 2nd tab
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "2"))
+PRELOAD_NEXT   = os.getenv("PRELOAD_NEXT", "0") == "1"
+
+RENDER_QUIET_MS = int(os.getenv("RENDER_QUIET_MS", "400"))  # chart DOM must be unchanged this long before capture
+
+# Session: log in once into a Chrome profile and start every thread's driver from a copy ("" = per-driver login)
+PROFILE_DIR           = os.getenv("PROFILE_DIR", ".tv_profile")
+PROFILE_REQUIRE_LOGIN = os.getenv("PROFILE_REQUIRE_LOGIN", "0") == "1"
+
+# Driver lifecycle: a thread's Chrome is replaced between rows after N charts or when its process tree
+# (chromedriver + Chrome + renderers) grows past the RSS limit; 0 disables a limit
+DRIVER_MAX_PAGES  = int(os.getenv("DRIVER_MAX_PAGES", "150"))
+DRIVER_MAX_RSS_MB = int(os.getenv("DRIVER_MAX_RSS_MB", "1500"))
+
+# Ads/analytics/social/media requests are dropped via CDP ("none" disables, "+p1,p2" extends the defaults)
+BLOCK_URLS = block_urls_from_env(os.getenv("BLOCK_URLS", ""))
+
+# Instrumentation: one JSON line per symbol with stage timings; optional node_exporter textfile
+METRICS_FILE  = os.getenv("METRICS_FILE", "metrics_nextbagger.jsonl")
+PROM_TEXTFILE = os.getenv("PROM_TEXTFILE", "")
+
+# Stop taking new rows this many minutes after start, so in-flight rows still drain before the job's
+# timeout-minutes (Actions only allows a few seconds between SIGTERM and SIGKILL); 0 disables
+RUN_DEADLINE_MINS = float(os.getenv("RUN_DEADLINE_MINS", "0"))
+RUN_STARTED = time.time()
+
+# Streaming: rows are read from the sheet page by page and fed through a bounded queue
+SHEET_PAGE_ROWS = int(os.getenv("SHEET_PAGE_ROWS", "500"))
+ROW_QUEUE_SIZE  = int(os.getenv("ROW_QUEUE_SIZE", "0")) or MAX_THREADS * 4
 
 progress_lock = threading.Lock()
-processed_count = 0
 total_rows = 0
+LOG_PREFIX = ""  # "[p2] " inside a worker process
 
-# counters
-skipped_no_date = 0
-skipped_bad_row = 0
-db_ok = 0
-db_fail = 0
-selenium_fail = 0
+# counters: only changed through bump(); with EXEC_MODE=process the parent adds up the workers' totals
+counts = dict.fromkeys(["processed", "skipped_no_date", "skipped_bad_row", "db_ok", "db_fail", "selenium_fail",
+                        "skipped_same", "bytes_raw", "bytes_stored", "preload_hits"], 0)
 
 DB_CONFIG = {
     "host": os.getenv("DB_HOST"),
@@ -53,16 +132,31 @@ DB_CONFIG = {
 }
 
 db_pool = None
+db_writer = None
+encode_pool = None
+encode_slots = None  # bounds the screenshots waiting for the encoder
+checkpoint = None
+controller = None
+metrics = None
+session = None
+supervisor = None
 thread_local = threading.local()
-drivers_lock = threading.Lock()
-all_drivers = []
+stop_event = threading.Event()  # set on SIGTERM/SIGINT: finish in-flight rows, take no new ones
 
 DATE_MAP = {}  # symbol -> yyyy-mm-dd
 
+HASH_COLUMN_READY = False  # IMAGE_DEDUP=1 and TARGET_TABLE has the screenshot_hash column
+
 
 # ---------------- HELPERS ---------------- #
 def log(msg):
-    print(msg, flush=True)
+    print(f"{LOG_PREFIX}{msg}", flush=True)
+
+def bump(name, n=1):
+    """Adds n to a run counter and returns the new value."""
+    with progress_lock:
+        counts[name] += n
+        return counts[name]
 
 def safe_str(e, n=260):
     try:
@@ -70,18 +164,20 @@ def safe_str(e, n=260):
     except:
         return "error"
 
-def col_letter_to_index(letter: str) -> int:
-    letter = letter.strip().upper()
-    n = 0
-    for ch in letter:
-        if "A" <= ch <= "Z":
-            n = n * 26 + (ord(ch) - ord("A") + 1)
-    return n - 1
+ISO_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
 
+@functools.lru_cache(maxsize=None)
 def normalize_date(val: str) -> str:
+    # the same few dates repeat across thousands of symbols, so results are memoized
     if not val:
         return ""
     s = str(val).strip()
+    if ISO_DATE_RE.match(s):
+        try:
+            datetime.strptime(s, "%Y-%m-%d")
+            return s
+        except ValueError:
+            return ""
     s = re.sub(r"[^\d/\-]", "", s)
     for fmt in ("%Y-%m-%d", "%Y/%m/%d", "%d-%m-%Y", "%d/%m/%Y"):
         try:
@@ -99,40 +195,365 @@ def preflight_env_check():
     log("✅ PRECHECK: Env vars present")
     return True
 
-def read_checkpoint():
-    try:
-        if os.path.exists(CHECKPOINT_FILE):
-            v = int(open(CHECKPOINT_FILE, "r").read().strip())
-            return max(v, -1)
-    except:
-        pass
-    return -1
+class ConcurrencyController:
+    """
+    AIMD gate over the worker threads. Each row's Selenium time and outcome is
+    observed; once per interval (with enough rows) the active limit is
+    - halved when the window's timeout/error rate, MemAvailable or load per CPU
+      crosses its threshold,
+    - lowered by one when the p50 row time is ADAPT_LAT_SLACK x the best p50, which
+      decays by ADAPT_BEST_DECAY per window so one lucky early window doesn't pin it,
+    - raised by one otherwise,
+    always within [min_workers, max_workers]. With adaptive=False the limit stays put.
+    """
 
-def write_checkpoint(i):
-    try:
-        with open(CHECKPOINT_FILE, "w") as f:
-            f.write(str(i))
-    except:
+    def __init__(self, min_workers, max_workers, start, adaptive=True, interval=45.0, min_rows=4):
+        self.min = min_workers
+        self.max = max_workers
+        self.limit = start if adaptive else max_workers
+        self.adaptive = adaptive
+        self.interval = interval
+        self.min_rows = min_rows
+        self.active = 0
+        self.cond = threading.Condition()
+        self.window = []  # (seconds, ok)
+        self.window_start = time.time()
+        self.best_p50 = None
+        self.decisions = 0
+        self.peak = self.limit
+
+    def acquire(self, on_park=None):
+        """Blocks while `limit` workers are busy; on_park() runs once before waiting (e.g. free the driver)."""
+        parked = False
+        with self.cond:
+            while self.active >= self.limit and not stop_event.is_set():
+                if on_park and not parked:
+                    parked = True
+                    self.cond.release()
+                    try:
+                        on_park()
+                    finally:
+                        self.cond.acquire()
+                    continue
+                self.cond.wait(timeout=1.0)
+            self.active += 1
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def observe(self, seconds, ok):
+        if not self.adaptive:
+            return
+        with self.cond:
+            self.window.append((seconds, ok))
+            if time.time() - self.window_start < self.interval or len(self.window) < self.min_rows:
+                return
+            window, self.window = self.window, []
+            self.window_start = time.time()
+            self._decide(window)
+
+    def _decide(self, window):
+        lat = sorted(s for s, ok in window if ok)
+        p50 = lat[len(lat) // 2] if lat else None
+        err = sum(1 for _, ok in window if not ok) / len(window)
+        mem = mem_available_mb()
+        try:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        except OSError:
+            load = None
+        best = self.best_p50 * ADAPT_BEST_DECAY if self.best_p50 is not None else p50
+
+        old = self.limit
+        if err > ADAPT_MAX_ERR_RATE:
+            new, why = old // 2, f"error rate {err:.0%} > {ADAPT_MAX_ERR_RATE:.0%}"
+        elif mem is not None and mem < ADAPT_MIN_MEM_MB:
+            new, why = old // 2, f"MemAvailable {mem:.0f}MB < {ADAPT_MIN_MEM_MB:.0f}MB"
+        elif load is not None and load > ADAPT_MAX_LOAD:
+            new, why = old // 2, f"load/cpu {load:.2f} > {ADAPT_MAX_LOAD}"
+        elif p50 is not None and p50 > best * ADAPT_LAT_SLACK:
+            new, why = old - 1, f"p50 {p50:.1f}s > {ADAPT_LAT_SLACK}x best {best:.1f}s"
+        else:
+            new, why = old + 1, "healthy"
+        if best is not None:
+            self.best_p50 = best if p50 is None else min(best, p50)
+        self.limit = max(self.min, min(self.max, new))
+        self.peak = max(self.peak, self.limit)
+        self.cond.notify_all()
+        if self.limit == old:
+            return
+        self.decisions += 1
+        log(f"🎛️ CONCURRENCY: {old} -> {self.limit} ({why}; rows={len(window)}, "
+            f"p50={'-' if p50 is None else f'{p50:.1f}s'}, err={err:.0%}, "
+            f"mem={'-' if mem is None else f'{mem:.0f}MB'}, load/cpu={'-' if load is None else f'{load:.2f}'})")
+
+
+class DriverSupervisor:
+    """
+    Registry of the per-thread drivers: charts opened and process-tree RSS of each.
+    due() tells a thread to replace its driver before the next row; retire() quits a
+    driver, drops its profile copy and sweeps chromedriver/Chrome processes left behind
+    by drivers that crashed or failed to quit.
+    """
+
+    def __init__(self, max_pages, max_rss_mb, marker=""):
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.marker = marker  # profile dir in Chrome's command line, to find re-parented orphans
+        self.lock = threading.Lock()
+        self.drivers = {}  # id(driver) -> [driver, charts, root pid]
+        self.started = 0
+        self.retired = {}  # reason -> count
+        self.peak_rss_mb = 0.0
+        self.orphans_killed = 0
+        self.starting = 0  # drivers being created: their chromedriver isn't registered yet
+
+    def start(self, factory):
+        with self.lock:
+            self.starting += 1
+        try:
+            d = factory()
+        except Exception:
+            with self.lock:
+                self.starting -= 1
+            raise
+        with self.lock:
+            self.starting -= 1
+            self.drivers[id(d)] = [d, 0, driver_root_pid(d)]
+            self.started += 1
+        return d
+
+    def note_page(self, d):
+        with self.lock:
+            if id(d) in self.drivers:
+                self.drivers[id(d)][1] += 1
+
+    def due(self, d):
+        """Why d should be replaced after the current row, None while it is within limits."""
+        with self.lock:
+            entry = self.drivers.get(id(d))
+            pages = entry[1] if entry else 0
+        if self.max_pages and pages >= self.max_pages:
+            return "pages"
+        rss = driver_rss_mb(d)
+        if rss is not None:
+            with self.lock:
+                self.peak_rss_mb = max(self.peak_rss_mb, rss)
+            if self.max_rss_mb and rss > self.max_rss_mb:
+                return "rss"
+        return None
+
+    def retire(self, d, reason):
+        rss = driver_rss_mb(d)
+        with self.lock:
+            entry = self.drivers.pop(id(d), None)
+            self.retired[reason] = self.retired.get(reason, 0) + 1
+        pages = entry[1] if entry else 0
+        log(f"♻️ DRIVER: retiring after {pages} charts, rss={'-' if rss is None else f'{rss:.0f}MB'} ({reason})")
+        metrics.count(f"driver_retire_{reason}")
+        try:
+            d.quit()
+        except:
+            pass
+        session.release(d)
+        self.sweep()
+
+    def sweep(self):
+        with self.lock:  # held so no driver starts mid-sweep
+            if self.starting:
+                return  # can't tell a half-started driver from an orphan; the next sweep catches up
+            keep = [e[2] for e in self.drivers.values()]
+            self.orphans_killed += kill_orphan_browsers(keep, self.marker, log=log)
+
+    def close(self):
+        with self.lock:
+            drivers = [e[0] for e in self.drivers.values()]
+            self.drivers.clear()
+        for d in drivers:
+            try:
+                d.quit()
+            except:
+                pass
+        self.sweep()
+
+    def stats(self):
+        with self.lock:
+            return {"started": self.started, "retired": dict(self.retired),
+                    "peak_rss_mb": self.peak_rss_mb, "orphans_killed": self.orphans_killed}
+
+    def merge(self, st):
+        """Adds a worker process's stats() to this (parent) supervisor."""
+        with self.lock:
+            self.started += st["started"]
+            for k, v in st["retired"].items():
+                self.retired[k] = self.retired.get(k, 0) + v
+            self.peak_rss_mb = max(self.peak_rss_mb, st["peak_rss_mb"])
+            self.orphans_killed += st["orphans_killed"]
+
+    def summary(self):
+        with self.lock:
+            retired = ", ".join(f"{k}={v}" for k, v in sorted(self.retired.items())) or "none"
+        return (f"started={self.started}, retired: {retired}, peak_rss={self.peak_rss_mb:.0f}MB, "
+                f"orphans_killed={self.orphans_killed}")
+
+
+class CheckpointManager:
+    """
+    Completed row indices for an exact resume with MAX_THREADS > 1.
+    The file holds {"watermark": w, "done": [...]}: every row <= w is done, plus the
+    sparse rows above it that finished out of order. Each mark rewrites the file
+    atomically (tmp + os.replace); fsync is batched to every fsync_secs.
+    A plain integer file from older runs is read as the watermark.
+    """
+
+    def __init__(self, path, fsync_secs=5.0):
+        self.path = path
+        self.fsync_secs = fsync_secs
+        self.lock = threading.Lock()
+        self.watermark = -1
+        self.done = set()
+        self.last_fsync = time.time()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                raw = f.read().strip()
+        except OSError:
+            return
+        try:
+            self.watermark = max(int(raw), -1)  # legacy: last finished row
+            return
+        except ValueError:
+            pass
+        try:
+            data = json.loads(raw)
+            self.watermark = max(int(data.get("watermark", -1)), -1)
+            self.done = {int(i) for i in data.get("done", []) if int(i) > self.watermark}
+            self._advance()
+        except (ValueError, TypeError, AttributeError) as e:
+            log(f"⚠️ CHECKPOINT: unreadable {self.path} ({safe_str(e)}), starting from scratch")
+
+    def _advance(self):
+        while self.watermark + 1 in self.done:
+            self.watermark += 1
+            self.done.discard(self.watermark)
+
+    def is_done(self, i):
+        return i <= self.watermark or i in self.done
+
+    def mark(self, i):
+        with self.lock:
+            if self.is_done(i):
+                return
+            self.done.add(i)
+            self._advance()
+            self._save(fsync=time.time() - self.last_fsync >= self.fsync_secs)
+
+    def _save(self, fsync=False):
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"watermark": self.watermark, "done": sorted(self.done)}, f)
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            if fsync:
+                self.last_fsync = time.time()
+        except OSError as e:
+            log(f"⚠️ CHECKPOINT: write failed: {safe_str(e)}")
+
+    def close(self):
+        with self.lock:
+            self._save(fsync=True)
+
+
+class RemoteCheckpoint:
+    """CheckpointManager stand-in inside a worker process: marks go to the parent, which owns the file."""
+
+    def __init__(self, results):
+        self.results = results
+
+    def mark(self, i):
+        self.results.put(("mark", i))
+
+    def close(self):
         pass
 
 
+# ---------------- MAIN SHEET ROWS ---------------- #
+def iter_sheet_rows(worksheet, page_rows=500):
+    """
+    Yields the tab's data rows as {header: value} dicts, fetching page_rows rows per request.
+    Duplicate headers keep their first column (same as the old DataFrame de-dup).
+    The API trims trailing blank rows from every range, so a short or empty page is not the
+    end of the tab: paging runs to worksheet.row_count, and blank rows are yielded (as the old
+    full load did) unless nothing follows them.
+    """
+    headers = [h.strip() for h in worksheet.row_values(1)]
+    cols = {}
+    for c, h in enumerate(headers):
+        cols.setdefault(h, c)
+    blank = {h: "" for h in cols}
+
+    pending_blanks = 0  # blank rows seen so far; only yielded once a later row has data
+    start, last = 2, worksheet.row_count
+    while start <= last and not stop_event.is_set():
+        end = min(start + page_rows - 1, last)
+        page = worksheet.get(f"{start}:{end}")
+        for values in page:
+            if not any(str(v).strip() for v in values):
+                pending_blanks += 1
+                continue
+            for _ in range(pending_blanks):
+                yield dict(blank)
+            pending_blanks = 0
+            yield {h: (values[c] if c < len(values) else "") for h, c in cols.items()}
+        pending_blanks += (end - start + 1) - len(page)  # trimmed from the end of this page
+        start = end + 1
+
+def iter_tasks(worksheet):
+    """(i, row) for this shard, i counting the shard's rows as before; checkpointed rows are skipped."""
+    i = -1
+    for idx, row in enumerate(iter_sheet_rows(worksheet, SHEET_PAGE_ROWS)):
+        if SHARD_STEP > 1 and (idx % SHARD_STEP) != SHARD_INDEX:
+            continue
+        i += 1
+        if not checkpoint.is_done(i):
+            yield i, row
+
+def check_deadline():
+    if RUN_DEADLINE_MINS and not stop_event.is_set() and time.time() - RUN_STARTED > RUN_DEADLINE_MINS * 60:
+        log(f"⏰ RUN_DEADLINE_MINS={RUN_DEADLINE_MINS:g} reached: draining in-flight rows, no new rows will start")
+        stop_event.set()
+
+def request_stop(signum, frame):
+    if not stop_event.is_set():
+        log(f"🛑 Signal {signum}: draining in-flight rows, no new rows will start")
+    stop_event.set()
+
+
 # ---------------- DATE MAP ---------------- #
 def load_date_map(gc):
     global DATE_MAP
     DATE_MAP = {}
 
-    sym_i = col_letter_to_index(DATE_SYMBOL_COL)
-    date_i = col_letter_to_index(DATE_COL_LETTER)
-
     ss = gc.open(DATE_SPREADSHEET_NAME)
     ws = ss.worksheet(DATE_TAB_NAME)
-    values = ws.get_all_values()
 
-    for r in values:
-        if len(r) <= max(sym_i, date_i):
+    # only the two columns we need; shards/restarts reuse the snapshot while the sheet is unchanged
+    sym_col, date_col = get_ranges_cached(
+        ws, [f"{DATE_SYMBOL_COL}:{DATE_SYMBOL_COL}", f"{DATE_COL_LETTER}:{DATE_COL_LETTER}"],
+        cache_dir=DATE_CACHE_DIR, ttl=DATE_CACHE_TTL, log=log,
+    )
+
+    for s_cell, d_cell in zip(sym_col, date_col):
+        if not s_cell or not d_cell:
             continue
-        sym = str(r[sym_i]).strip()
-        dt = normalize_date(r[date_i])
+        sym = str(s_cell[0]).strip()
+        dt = normalize_date(str(d_cell[0]))
         if sym and dt:
             DATE_MAP[sym.upper()] = dt
 
@@ -150,12 +571,7 @@ def db_network_diagnostics():
     except Exception as e:
         log(f"⚠️ CHECKPOINT: DNS resolve failed for {host}: {safe_str(e)}")
 
-def init_db_pool():
-    global db_pool
-
-    db_network_diagnostics()
-
-    # 1) Direct connect test (proves real reason)
+def direct_connect_test():
     try:
         log("🔎 CHECKPOINT: Direct connect test (no pool)...")
         c = mysql.connector.connect(**DB_CONFIG)
@@ -165,17 +581,27 @@ def init_db_pool():
         cur.close()
         c.close()
         log(f"✅ CHECKPOINT: Direct connect OK (db={dbname})")
+        return True
     except Exception as e:
         log(f"❌ CHECKPOINT: Direct connect FAILED: {repr(e)}")
         return False
 
+def init_db_pool(pool_size=None, diagnose=True):
+    global db_pool
+
+    # 1) Direct connect test (proves real reason); worker processes skip it, the parent already ran it
+    if diagnose:
+        db_network_diagnostics()
+        if not direct_connect_test():
+            return False
+
     # 2) Pool with retries (Hostinger sometimes unstable)
     for attempt in range(1, 6):
         try:
             log(f"📡 CHECKPOINT: Connecting to Database pool... attempt={attempt}/5")
             db_pool = mysql.connector.pooling.MySQLConnectionPool(
                 pool_name="screenshot_pool",
-                pool_size=max(2, MAX_THREADS),
+                pool_size=pool_size or max(2, MAX_THREADS),
                 pool_reset_session=True,
                 **DB_CONFIG
             )
@@ -189,43 +615,179 @@ def init_db_pool():
 
     return False
 
-def save_to_mysql(symbol, timeframe, image_data, chart_date, month_val):
-    if db_pool is None:
-        return False
+def upsert_sql(with_hash):
+    cols = "symbol, timeframe, screenshot, chart_date, month_before" + (", screenshot_hash" if with_hash else "")
+    marks = ", ".join(["%s"] * (6 if with_hash else 5))
+    return f"""
+        INSERT INTO {TARGET_TABLE} ({cols})
+        VALUES ({marks})
+        ON DUPLICATE KEY UPDATE
+            screenshot = VALUES(screenshot),
+            chart_date = VALUES(chart_date),
+            month_before = VALUES(month_before),
+            {"screenshot_hash = VALUES(screenshot_hash)," if with_hash else ""}
+            created_at = CURRENT_TIMESTAMP
+    """
+
+def check_hash_column():
+    """
+    IMAGE_DEDUP needs a screenshot_hash column in TARGET_TABLE. The scraper never runs DDL:
+    when the column is missing (see migrations/next_bagger_screenshot_hash.sql) dedup is disabled.
+    """
+    global HASH_COLUMN_READY
+    conn = None
+    try:
+        conn = db_pool.get_connection() if db_pool else mysql.connector.connect(**DB_CONFIG)
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT COUNT(*) FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = 'screenshot_hash'",
+            (TARGET_TABLE,))
+        HASH_COLUMN_READY = cur.fetchone()[0] > 0
+        cur.close()
+        if HASH_COLUMN_READY:
+            log("✅ CHECKPOINT: Screenshot dedup on (screenshot_hash column present)")
+        else:
+            log(f"⚠️ CHECKPOINT: {TARGET_TABLE}.screenshot_hash missing, dedup disabled "
+                f"(apply migrations/next_bagger_screenshot_hash.sql)")
+    except Exception as e:
+        log(f"⚠️ CHECKPOINT: Screenshot dedup disabled: {safe_str(e)}")
+    finally:
+        try:
+            if conn:
+                conn.close()
+        except:
+            pass
+
+def stored_hashes(symbol, timeframes, chart_date):
+    """{timeframe: hash} of this symbol's stored screenshots for chart_date, via the (symbol, timeframe) unique key."""
+    conn = None
     try:
         conn = db_pool.get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT DATABASE()")
-        current_db = cursor.fetchone()[0]
-
-        query = f"""
-            INSERT INTO {TARGET_TABLE} (symbol, timeframe, screenshot, chart_date, month_before)
-            VALUES (%s, %s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE
-                screenshot = VALUES(screenshot),
-                chart_date = VALUES(chart_date),
-                month_before = VALUES(month_before),
-                created_at = CURRENT_TIMESTAMP
+        cur = conn.cursor()
+        marks = ", ".join(["%s"] * len(timeframes))
+        cur.execute(f"SELECT timeframe, chart_date, screenshot_hash FROM {TARGET_TABLE} "
+                    f"WHERE symbol = %s AND timeframe IN ({marks})", (symbol, *timeframes))
+        found = {str(tf): h for tf, dt, h in cur.fetchall() if h and str(dt) == chart_date}
+        cur.close()
+        return found
+    except Exception as e:
+        log(f"⚠️ DEDUP lookup failed for {symbol}: {safe_str(e)}")
+        return {}
+    finally:
+        try:
+            if conn:
+                conn.close()
+        except:
+            pass
+
+class DbWriter:
+    """
+    Background thread fed by a bounded queue. Screenshots are grouped into
+    multi-row executemany upserts (up to DB_BATCH_SIZE rows / DB_BATCH_MAX_BYTES,
+    or whatever arrived within DB_FLUSH_SECS) with one commit per batch.
+    on_done(item, ok) is called for every item once its batch is committed or
+    has failed; ok/fail counts come from these tallies, not from the table.
+    """
+
+    def __init__(self, pool, on_done, batch_size=8, max_bytes=8 * 1024 * 1024, flush_secs=3.0, max_queue=16,
+                 with_hash=False):
+        self.pool = pool
+        self.with_hash = with_hash
+        self.sql = upsert_sql(with_hash)
+        self.on_done = on_done
+        self.batch_size = max(1, batch_size)
+        self.max_bytes = max_bytes
+        self.flush_secs = flush_secs
+        self.q = queue.Queue(maxsize=max_queue)  # full queue = backpressure on the workers
+        self.rows_ok = 0
+        self.rows_fail = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, items):
         """
-        cursor.execute(query, (symbol, timeframe, image_data, chart_date, month_val))
-        conn.commit()
+        items: list of dict(row, symbol, timeframe, img, chart_date, month_val, img_hash).
+        All screenshots of one call land in the same batch.
+        """
+        if items:
+            self.q.put(list(items))
 
-        cursor.execute(f"SELECT COUNT(*) FROM {TARGET_TABLE}")
-        total = cursor.fetchone()[0]
+    def close(self):
+        self.q.put(None)
+        self.thread.join()
 
-        log(f"✅ DB CONFIRM: host={DB_CONFIG['host']} db={current_db} table={TARGET_TABLE} total_rows_now={total}")
+    def _run(self):
+        batch, size, deadline = [], 0, None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.time())
+            try:
+                items = self.q.get(timeout=timeout)
+            except queue.Empty:
+                items = False  # flush timer expired
+
+            if items:
+                nbytes = sum(len(it["img"]) for it in items)
+                # flush first rather than let this call push the batch past its limits
+                if batch and (size + nbytes > self.max_bytes or len(batch) + len(items) > self.batch_size):
+                    self._flush(batch)
+                    batch, size, deadline = [], 0, None
+                if not batch:
+                    deadline = time.time() + self.flush_secs
+                batch.extend(items)
+                size += nbytes
+
+            if batch and (not items or len(batch) >= self.batch_size or size >= self.max_bytes):
+                self._flush(batch)
+                batch, size, deadline = [], 0, None
+
+            if items is None:
+                return
+
+    def _flush(self, batch):
+        params = [(it["symbol"], it["timeframe"], it["img"], it["chart_date"], it["month_val"])
+                  + ((it["img_hash"],) if self.with_hash else ()) for it in batch]
+        ok = False
+        t0 = time.perf_counter()
+        for attempt in range(1, 4):
+            conn = None
+            try:
+                conn = self.pool.get_connection()
+                cursor = conn.cursor()
+                cursor.executemany(self.sql, params)
+                conn.commit()
+                cursor.close()
+                ok = True
+                metrics.observe("db_upsert", time.perf_counter() - t0)
+                break
+            except Exception as err:
+                log(f"    ❌ DB BATCH ERROR ({len(batch)} rows) attempt {attempt}/3: {repr(err)}")
+                time.sleep(2 * attempt)
+            finally:
+                try:
+                    if conn:
+                        conn.close()
+                except:
+                    pass
 
-        cursor.close()
-        conn.close()
-        return True
-    except Exception as err:
-        log(f"    ❌ DB SAVE ERROR [{symbol}]: {repr(err)}")
-        return False
+        with progress_lock:
+            self.batches += 1
+            if ok:
+                self.rows_ok += len(batch)
+            else:
+                self.rows_fail += len(batch)
+        if ok:
+            log(f"✅ DB BATCH: {len(batch)} rows upserted -> {TARGET_TABLE} (total ok={self.rows_ok}, batches={self.batches})")
+        for it in batch:
+            try:
+                self.on_done(it, ok)
+            except Exception as e:
+                log(f"⚠️ DB on_done failed row#{it.get('row')}: {safe_str(e)}")
 
 
 # ---------------- BROWSER ---------------- #
-def get_driver():
+def get_driver(user_data_dir=None):
     opts = Options()
 
     # ✅ Chromium binary fix (GitHub runner)
@@ -255,20 +817,79 @@ def get_driver():
         "profile.default_content_setting_values.notifications": 2,
     }
     opts.add_experimental_option("prefs", prefs)
+    if user_data_dir:
+        opts.add_argument(f"--user-data-dir={os.path.abspath(user_data_dir)}")
 
     d = webdriver.Chrome(options=opts)
+    install_resource_filter(d, BLOCK_URLS)
     d.set_page_load_timeout(45)
     d.implicitly_wait(0)
     return d
 
-def kill_thread_driver():
+def kill_thread_driver(reason="error"):
+    d = getattr(thread_local, "driver", None)
+    thread_local.driver = None
+    thread_local.preloaded = None
+    thread_local.recycle = None
+    if d:
+        supervisor.retire(d, reason)
+
+def preload_tab(driver, url):
+    """Opens url in a background tab of this driver; the current tab keeps focus."""
+    discard_preloaded(driver)
+    cur = None
     try:
-        d = getattr(thread_local, "driver", None)
-        if d:
-            d.quit()
+        cur = driver.current_window_handle
+        before = set(driver.window_handles)
+        driver.execute_script("window.open('about:blank', '_blank');")
+        new = [h for h in driver.window_handles if h not in before]
+        if new:
+            # CDP blocking is per target: filter the blank tab before it starts loading
+            driver.switch_to.window(new[0])
+            install_resource_filter(driver, BLOCK_URLS)
+            driver.execute_script("window.location.href = arguments[0];", url)
+            driver.switch_to.window(cur)
+            thread_local.preloaded = (url, new[0])
+    except Exception as e:
+        log(f"⚠️ PRELOAD failed: {safe_str(e)}")
+        try:
+            if cur and driver.current_window_handle != cur:
+                driver.switch_to.window(cur)
+        except:
+            pass
+
+def discard_preloaded(driver):
+    pre = getattr(thread_local, "preloaded", None)
+    thread_local.preloaded = None
+    if not pre:
+        return
+    try:
+        cur = driver.current_window_handle
+        driver.switch_to.window(pre[1])
+        driver.close()
+        driver.switch_to.window(cur)
     except:
         pass
-    thread_local.driver = None
+
+def open_chart(driver, url):
+    """Switches to the preloaded tab for url (closing the old one), else a normal driver.get()."""
+    pre = getattr(thread_local, "preloaded", None)
+    if pre and pre[0] == url:
+        thread_local.preloaded = None
+        try:
+            old = driver.current_window_handle
+            driver.switch_to.window(old)
+            driver.close()
+            driver.switch_to.window(pre[1])
+            bump("preload_hits")
+            return
+        except Exception as e:
+            log(f"⚠️ PRELOAD switch failed, reloading: {safe_str(e)}")
+            driver.switch_to.window(driver.window_handles[-1])
+            install_resource_filter(driver, BLOCK_URLS)
+    else:
+        discard_preloaded(driver)
+    driver.get(url)
 
 def force_clear_ads(driver):
     try:
@@ -298,88 +919,42 @@ def wait_chart_ready(driver, timeout=20):
         EC.presence_of_element_located((By.XPATH, "//div[contains(@class,'chart-container')]"))
     )
 
-# ✅ NEW: waits just enough so indicators finish drawing (fast on already-loaded charts)
-def wait_chart_stable_for_screenshot(driver, chart_el, max_wait=6.0):
+# ✅ waits just enough so indicators finish drawing (fast on already-loaded charts)
+def wait_chart_stable_for_screenshot(driver, max_wait=6.0):
     """
-    Goal: avoid screenshot before indicators load.
-    Fast path: if already stable, returns quickly (usually < 0.8s).
-    Strategy:
-      1) wait until typical loading spinners/progress are gone (best-effort)
-      2) require 2 consecutive identical chart element screenshots (hash-based)
+    Goal: avoid screenshot before indicators load, without screenshotting to find out.
+    Uses tv_browser's render probe: loaders gone, legend values filled, DOM quiet.
     """
-    end = time.time() + max_wait
-
-    def has_loading():
-        try:
-            return driver.execute_script("""
-                const sels = [
-                  "[data-name='spinner']",
-                  "[class*='spinner']",
-                  "[class*='loading']",
-                  "[class*='progress']",
-                  "div[class*='loader']"
-                ];
-                for (const s of sels) {
-                  const el = document.querySelector(s);
-                  if (el && el.offsetParent !== null) return true;
-                }
-                return false;
-            """)
-        except:
-            return False
+    try:
+        secs, settled = wait_chart_rendered(driver, timeout=max_wait, quiet_ms=RENDER_QUIET_MS)
+    except:
+        return False
+    if not settled:
+        log(f"   ⚠️ STABILIZE: chart not settled after {secs:.1f}s, capturing anyway")
+    # if time runs out, still return True-ish (we tried); caller can proceed
+    return True
 
-    # (1) brief wait for loaders to disappear (doesn't block long)
-    while time.time() < end and has_loading():
-        time.sleep(0.25)
+def cookie_login(d):
+    d.get("https://www.tradingview.com/chart/")
 
-    # (2) stability via element screenshot hash
-    last_h = None
-    stable_hits = 0
-    while time.time() < end:
+    cookie_data = os.getenv("TRADINGVIEW_COOKIES")
+    if cookie_data:
         try:
-            png = chart_el.screenshot_as_png
-            h = hashlib.md5(png).hexdigest()
-        except:
-            # if element reference became stale, caller will re-find chart
-            return False
-
-        if h == last_h:
-            stable_hits += 1
-            if stable_hits >= 2:
-                return True
-        else:
-            stable_hits = 0
-            last_h = h
-
-        time.sleep(0.35)
-
-    # if time runs out, still return True-ish (we tried); caller can proceed
-    return True
+            cookies = json.loads(cookie_data)
+            inject_cookies(d, cookies, domain=".tradingview.com")
+            d.refresh()
+            log("✅ CHECKPOINT: Cookies injected and refreshed")
+        except Exception as e:
+            log(f"⚠️ CHECKPOINT: Cookie load failed: {safe_str(e)}")
 
 def ensure_thread_driver_logged_in():
+    reason = getattr(thread_local, "recycle", None)
+    if reason and getattr(thread_local, "driver", None) is not None:
+        kill_thread_driver(reason)  # between rows: nothing is in flight on this driver
     if getattr(thread_local, "driver", None) is None:
-        d = get_driver()
+        with metrics.timed("driver_start"):
+            d = supervisor.start(session.new_driver)  # profile copy: already logged in, no extra navigation
         thread_local.driver = d
-        with drivers_lock:
-            all_drivers.append(d)
-
-        d.get("https://www.tradingview.com/chart/")
-
-        cookie_data = os.getenv("TRADINGVIEW_COOKIES")
-        if cookie_data:
-            try:
-                cookies = json.loads(cookie_data)
-                for c in cookies:
-                    d.add_cookie({
-                        "name": c.get("name"),
-                        "value": c.get("value"),
-                        "domain": ".tradingview.com",
-                        "path": "/"
-                    })
-                d.refresh()
-                log("✅ CHECKPOINT: Cookies injected and refreshed")
-            except Exception as e:
-                log(f"⚠️ CHECKPOINT: Cookie load failed: {safe_str(e)}")
 
     return thread_local.driver
 
@@ -403,114 +978,395 @@ def goto_date_fast(driver, chart_el, target_date):
     time.sleep(0.6)
     force_clear_ads(driver)
 
+def switch_interval(driver, chart_el, code):
+    """Types the interval on the focused chart (TradingView's interval dialog) - no page reload."""
+    ActionChains(driver).move_to_element(chart_el).click().perform()
+    time.sleep(0.1)
+    ActionChains(driver).send_keys(code).perform()
+    time.sleep(0.3)
+    ActionChains(driver).send_keys(Keys.ENTER).perform()
+    time.sleep(0.5)
+    force_clear_ads(driver)
+
+def capture_chart(driver, symbol, tf, rec):
+    # ✅ UPDATED: wait for indicators to fully draw, but keep it fast
+    log(f"   ⏳ STABILIZE: {symbol} [{tf}] (fast wait for indicators)")
+    with rec.stage("stabilize"):
+        force_clear_ads(driver)
+        wait_chart_stable_for_screenshot(driver, max_wait=6.0)
+
+    log(f"   📸 SCREENSHOT: {symbol} [{tf}]")
+    with rec.stage("screenshot"):
+        # one last re-grab (handles rare DOM refresh)
+        chart = wait_chart_ready(driver, timeout=10)
+        force_clear_ads(driver)
+        img = chart.screenshot_as_png
+        crop_box = chart_crop_box(driver, chart) if IMAGE_CROP else None
+    return img, crop_box
+
+
+# ---------------- IMAGE ---------------- #
+def chart_crop_box(driver, chart_el):
+    """Main price pane as (left, top, right, bottom) in screenshot pixels, None if not found."""
+    try:
+        return driver.execute_script("""
+            const root = arguments[0], pane = root.querySelector(arguments[1]);
+            if (!pane) return null;
+            const a = root.getBoundingClientRect(), b = pane.getBoundingClientRect();
+            const k = window.devicePixelRatio || 1;
+            return [b.left - a.left, b.top - a.top, b.right - a.left, b.bottom - a.top].map(v => Math.round(v * k));
+        """, chart_el, IMAGE_CROP_SELECTOR)
+    except:
+        return None
+
+def encode_screenshot(png, crop_box=None):
+    """Applies IMAGE_CROP / IMAGE_FORMAT; falls back to the raw PNG without Pillow or on error."""
+    if (IMAGE_FORMAT == "png" and not crop_box) or Image is None:
+        return png
+    try:
+        im = Image.open(io.BytesIO(png))
+        if crop_box:
+            im = im.crop(tuple(crop_box))
+        out = io.BytesIO()
+        if IMAGE_FORMAT == "webp":
+            im.save(out, "WEBP", quality=IMAGE_QUALITY, method=4)
+        else:
+            im.save(out, "PNG", optimize=(IMAGE_FORMAT == "png-opt"))
+        return out.getvalue()
+    except Exception as e:
+        log(f"⚠️ IMAGE ENCODE failed, storing raw PNG: {safe_str(e)}")
+        return png
+
 
 # ---------------- WORKER ---------------- #
-def process_row(task):
-    global processed_count, skipped_no_date, skipped_bad_row, db_ok, db_fail, selenium_fail
+def row_symbol_url(row):
+    row_clean = {str(k).lower().strip(): v for k, v in row.items()}
+    return str(row_clean.get('symbol', '')).strip(), str(row_clean.get('day', '')).strip()
 
+def process_row(task, next_task=None):
+    """Selenium part of a row; the screenshots are handed to the encoder and DB writer."""
     i, row = task
 
     try:
-        row_clean = {str(k).lower().strip(): v for k, v in row.items()}
-        symbol = str(row_clean.get('symbol', '')).strip()
-        day_url = str(row_clean.get('day', '')).strip()
+        symbol, day_url = row_symbol_url(row)
 
         if not symbol or "tradingview.com" not in day_url:
-            with progress_lock:
-                skipped_bad_row += 1
+            bump("skipped_bad_row")
             log(f"⏭️ SKIP row#{i}: bad row (symbol/url missing) symbol='{symbol}' url='{day_url}'")
-            write_checkpoint(i)
+            checkpoint.mark(i)
             return
 
         target_date = DATE_MAP.get(symbol.upper(), "")
         if not target_date:
-            with progress_lock:
-                skipped_no_date += 1
+            bump("skipped_no_date")
             log(f"⏭️ SKIP row#{i}: {symbol} -> NO DATE in {DATE_SPREADSHEET_NAME}/{DATE_TAB_NAME} col {DATE_COL_LETTER}")
-            write_checkpoint(i)
+            checkpoint.mark(i)
             return
 
-        with progress_lock:
-            processed_count += 1
-            current_idx = processed_count
+        current_idx = bump("processed")
 
-        log(f"🚀 START row#{i} [{current_idx}/{total_rows}] {symbol} | date={target_date}")
+        progress = f"#{current_idx} of this worker" if EXEC_MODE == "process" else f"{current_idx}/{total_rows}"
+        log(f"🚀 START row#{i} [{progress}] {symbol} | date={target_date}")
+        rec = metrics.record(symbol, row=i, chart_date=target_date)
 
+        t_sel = time.time()
         try:
-            driver = ensure_thread_driver_logged_in()
+            with rec.stage("driver"):
+                driver = ensure_thread_driver_logged_in()
+            t_sel = time.time()  # a cold Chrome start after unparking/recycling is not row latency
 
             log(f"   🌐 GET: {symbol}")
-            driver.get(day_url)
+            with rec.stage("page_load"):
+                open_chart(driver, day_url)
+            supervisor.note_page(driver)
 
             log(f"   📈 WAIT CHART: {symbol}")
-            chart = wait_chart_ready(driver, timeout=20)
-            force_clear_ads(driver)
+            with rec.stage("chart_ready"):
+                chart = wait_chart_ready(driver, timeout=20)
+                force_clear_ads(driver)
+
+            thread_local.recycle = supervisor.due(driver)  # acted on before the next row
+            if thread_local.recycle:
+                log(f"   ♻️ DRIVER: {thread_local.recycle} limit reached, replacing after {symbol}")
+            elif PRELOAD_NEXT and next_task is not None:
+                next_url = row_symbol_url(next_task[1])[1]
+                if "tradingview.com" in next_url:
+                    preload_tab(driver, next_url)
 
             log(f"   🗓️ GOTO DATE: {symbol} -> {target_date}")
-            goto_date_fast(driver, chart, target_date)
-
-            # ✅ UPDATED: wait for indicators to fully draw, but keep it fast
-            log(f"   ⏳ STABILIZE: {symbol} (fast wait for indicators)")
-            chart = wait_chart_ready(driver, timeout=15)  # re-grab
-            force_clear_ads(driver)
-            wait_chart_stable_for_screenshot(driver, chart, max_wait=6.0)
-
-            log(f"   📸 SCREENSHOT: {symbol}")
-            # one last re-grab (handles rare DOM refresh)
-            chart = wait_chart_ready(driver, timeout=10)
-            force_clear_ads(driver)
-            img = chart.screenshot_as_png
+            with rec.stage("goto_date"):
+                goto_date_fast(driver, chart, target_date)
+
+            shots = []  # (timeframe, png, crop_box)
+            current_tf = "day"  # the sheet's URL opens the daily chart
+            for n, tf in enumerate(TIMEFRAMES):
+                try:
+                    if tf != current_tf:
+                        log(f"   🔀 INTERVAL: {symbol} -> {tf}")
+                        with rec.stage("interval_switch"):
+                            chart = wait_chart_ready(driver, timeout=15)
+                            switch_interval(driver, chart, TIMEFRAME_CODES.get(tf, tf))
+                            current_tf = tf
+                            if TIMEFRAME_REJUMP:
+                                goto_date_fast(driver, wait_chart_ready(driver, timeout=15), target_date)
+                    shots.append((tf,) + capture_chart(driver, symbol, tf, rec))
+                except Exception as te:
+                    if n == 0:
+                        raise
+                    bump("selenium_fail")
+                    log(f"⚠️ TIMEFRAME {tf} failed row#{i}: {symbol} -> {safe_str(te)}")
+
+            reqs, nbytes = page_traffic(driver)
+            metrics.count("pages")
+            metrics.count("requests", reqs)
+            metrics.count("bytes", nbytes)
+            rec.fields.update(requests=reqs, bytes=nbytes)
+            log(f"   📦 TRAFFIC: {symbol} {reqs} req, {nbytes/1024:.0f}KB")
+            controller.observe(time.time() - t_sel, ok=True)
 
         except Exception as se:
-            with progress_lock:
-                selenium_fail += 1
-                db_fail += 1
+            controller.observe(time.time() - t_sel, ok=False)
+            bump("selenium_fail")
+            bump("db_fail")
             log(f"⚠️ SELENIUM ERROR row#{i}: {symbol} -> {safe_str(se)}")
             kill_thread_driver()
-            write_checkpoint(i)
+            metrics.emit(rec, status="selenium_error")
+            checkpoint.mark(i)
             return
 
+        with rec.stage("encode_wait"):
+            encode_slots.acquire()  # backpressure when the encoder/DB fall behind
+        try:
+            encode_pool.submit(finish_row, i, symbol, target_date, shots, rec)
+        except Exception:
+            encode_slots.release()  # finish_row never runs, so it can't give the slot back
+            raise
+
+    except Exception as e:
+        bump("db_fail")
+        log(f"🔥 FATAL ROW ERROR row#{i}: {safe_str(e)}")
+        checkpoint.mark(i)
+        return
+
+
+def finish_row(i, symbol, target_date, shots, rec):
+    """Encoder thread: dedup + encode the screenshots of one row and queue them for the DB writer."""
+    status = "queued"
+    try:
         month_val = "Unknown"
         try:
             month_val = datetime.strptime(target_date, "%Y-%m-%d").strftime('%B')
         except:
             pass
 
-        ok = save_to_mysql(symbol, "day", img, target_date, month_val)
-        with progress_lock:
-            if ok:
-                db_ok += 1
-            else:
-                db_fail += 1
-
-        if ok:
-            log(f"✅ DB OK row#{i}: inserted/updated {symbol} ({target_date}) -> {TARGET_TABLE}")
+        known = stored_hashes(symbol, [tf for tf, _, _ in shots], target_date) if HASH_COLUMN_READY and shots else {}
+        items = []
+        for tf, img, crop_box in shots:
+            img_hash = hashlib.md5(img).hexdigest()
+            if known.get(tf) == img_hash:
+                bump("skipped_same")
+                log(f"⏭️ SAME row#{i}: {symbol} [{tf}] ({target_date}) unchanged, upsert skipped")
+                continue
+
+            raw_len = len(img)
+            with rec.stage("encode"):
+                img = encode_screenshot(img, crop_box)
+            bump("bytes_raw", raw_len)
+            bump("bytes_stored", len(img))
+            items.append({"row": i, "symbol": symbol, "timeframe": tf, "img": img,
+                          "chart_date": target_date, "month_val": month_val, "img_hash": img_hash})
+
+        if items:
+            with rec.stage("db_enqueue"):
+                db_writer.submit(items)  # all timeframes of this symbol go out in one batch
         else:
-            log(f"❌ DB FAIL row#{i}: {symbol} ({target_date}) -> {TARGET_TABLE}")
-
-        write_checkpoint(i)
-
+            status = "unchanged"
+            checkpoint.mark(i)
     except Exception as e:
-        with progress_lock:
-            db_fail += 1
-        log(f"🔥 FATAL ROW ERROR row#{i}: {safe_str(e)}")
-        write_checkpoint(i)
-        return
+        status = "encode_error"
+        bump("db_fail")
+        log(f"🔥 ENCODE ERROR row#{i}: {safe_str(e)}")
+        checkpoint.mark(i)
+    finally:
+        encode_slots.release()
+        metrics.emit(rec, status=status, timeframes=len(shots))
+
+
+def on_db_done(item, ok):
+    i = item["row"]
+    bump("db_ok" if ok else "db_fail")
+
+    if ok:
+        log(f"✅ DB OK row#{i}: inserted/updated {item['symbol']} [{item['timeframe']}] ({item['chart_date']}) -> {TARGET_TABLE}")
+    else:
+        log(f"❌ DB FAIL row#{i}: {item['symbol']} [{item['timeframe']}] ({item['chart_date']}) -> {TARGET_TABLE}")
+
+    checkpoint.mark(i)
+
+
+# ---------------- WORKERS ---------------- #
+def run_worker(tasks):
+    """One Selenium worker: pulls rows until its sentinel (None) or a stop signal."""
+    # the worker pulls its next row itself, so it can preload it while finishing the current one
+    nxt, last = None, False
+    while not stop_event.is_set():
+        controller.acquire(on_park=functools.partial(kill_thread_driver, "parked"))  # a parked thread gives its Chrome back
+        try:
+            task = nxt if nxt is not None else tasks.get()
+            nxt = None
+            if task is None:
+                break
+            if PRELOAD_NEXT and not last:
+                try:
+                    nxt = tasks.get_nowait()
+                    last = nxt is None  # took this worker's sentinel: finish the current row, then stop
+                except queue.Empty:
+                    pass
+            try:
+                process_row(task, nxt)
+            except Exception as e:
+                log(f"🔥 THREAD CRASH: {repr(e)}")
+            if last:
+                break
+        finally:
+            controller.release()
+
+def start_row_pipeline(workers):
+    """DB writer + encoder pool for `workers` Selenium workers in this process."""
+    global db_writer, encode_pool, encode_slots
+    db_writer = DbWriter(db_pool, on_db_done, batch_size=DB_BATCH_SIZE, max_bytes=DB_BATCH_MAX_BYTES,
+                         flush_secs=DB_FLUSH_SECS, max_queue=max(4, workers * 4), with_hash=HASH_COLUMN_READY)
+    encode_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, ENCODE_WORKERS))
+    encode_slots = threading.BoundedSemaphore(max(2, workers * 2))
+
+def stop_row_pipeline():
+    encode_pool.shutdown(wait=True)
+    db_writer.close()  # drain queued screenshots before tearing down
+
+def process_worker(wid, tasks, results, shared_stop):
+    """
+    EXEC_MODE=process: body of one forked worker. Owns one driver, a small DB pool, a DB writer
+    and an encoder; checkpoint marks and, at the end, its counters go back to the parent.
+    """
+    global LOG_PREFIX, checkpoint, metrics, controller, supervisor
+    LOG_PREFIX = f"[p{wid}] "
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    threading.Thread(target=relay_stop, args=(shared_stop,), name="stop-relay", daemon=True).start()
+
+    checkpoint = RemoteCheckpoint(results)
+    metrics = Metrics("nextbagger", jsonl_path=METRICS_FILE, log=log)  # appends to the parent's file
+    controller = ConcurrencyController(1, 1, 1, adaptive=False)
+    supervisor = DriverSupervisor(DRIVER_MAX_PAGES, DRIVER_MAX_RSS_MB,
+                                  marker=os.path.abspath(PROFILE_DIR) if PROFILE_DIR else "")
+    db = {"batches": 0, "rows_ok": 0, "rows_fail": 0}
+    try:
+        if not init_db_pool(pool_size=2, diagnose=False):
+            log("❌ WORKER: no DB pool, exiting")
+            return
+        start_row_pipeline(1)
+        run_worker(tasks)
+        stop_row_pipeline()
+        db = {"batches": db_writer.batches, "rows_ok": db_writer.rows_ok, "rows_fail": db_writer.rows_fail}
+    except Exception as e:
+        log(f"🔥 WORKER CRASH: {repr(e)}")
+    finally:
+        supervisor.close()
+        session.cleanup()  # atexit doesn't run in a forked child
+        metrics.close()
+        results.put(("stats", wid, {"counts": dict(counts), "db": db, "metrics": metrics.snapshot(),
+                                    "drivers": supervisor.stats()}))
+
+def relay_stop(shared_stop):
+    # polls a lock-free flag: an mp.Event waiter that exits would hang the parent's set()
+    while not shared_stop.value:
+        time.sleep(0.5)
+    stop_event.set()
+
+def collect_results(results, db_totals):
+    """Parent side of EXEC_MODE=process: applies the workers' checkpoint marks and merges their stats."""
+    while True:
+        msg = results.get()
+        if msg is None:
+            return
+        if msg[0] == "mark":
+            checkpoint.mark(msg[1])
+        elif msg[0] == "stats":
+            st = msg[2]
+            with progress_lock:
+                for k, v in st["counts"].items():
+                    counts[k] += v
+                for k, v in st["db"].items():
+                    db_totals[k] += v
+            metrics.merge(*st["metrics"])
+            supervisor.merge(st["drivers"])
+
+def run_processes(tasks, feeder, db_totals):
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    shared_stop = ctx.RawValue("b", 0)  # parent -> workers: stop taking rows
+    procs = [ctx.Process(target=process_worker, args=(k, tasks, results, shared_stop), name=f"nextbagger-p{k}", daemon=True)
+             for k in range(1, MAX_THREADS + 1)]
+    for p in procs:
+        p.start()  # forked before the producer/collector threads; workers open their own DB pools
+    collector = threading.Thread(target=collect_results, args=(results, db_totals), name="results", daemon=True)
+    collector.start()
+    feeder.start()
+
+    alive = procs
+    while alive:  # short joins keep the main process responsive to signals
+        check_deadline()
+        if stop_event.is_set():
+            shared_stop.value = 1
+        alive[0].join(timeout=1.0)
+        alive = [p for p in alive if p.is_alive()]
+    for p in procs:
+        if p.exitcode:
+            log(f"🔥 WORKER {p.name} exited with code {p.exitcode}")
+    results.put(None)  # after every worker's own messages
+    collector.join()
+    tasks.cancel_join_thread()  # rows left for crashed workers must not block exit
 
 
 # ---------------- MAIN ---------------- #
 def main():
-    global total_rows
+    global total_rows, checkpoint, session, metrics, controller, supervisor, EXEC_MODE
 
     log("🏁 CHECKPOINT: Script started")
+    if EXEC_MODE not in ("thread", "process"):
+        log(f"⚠️ CHECKPOINT: unknown EXEC_MODE={EXEC_MODE!r}, using threads")
+        EXEC_MODE = "thread"
+    metrics = Metrics("nextbagger", jsonl_path=METRICS_FILE, prom_path=PROM_TEXTFILE, log=log)
     log(f"✅ CHECKPOINT: Target table = {TARGET_TABLE}")
 
     if not preflight_env_check():
         return
 
-    if not init_db_pool():
+    if EXEC_MODE == "process":
+        # no pool here: only the workers write, each through its own small pool
+        db_network_diagnostics()
+        if not direct_connect_test():
+            return
+    elif not init_db_pool():
+        return
+
+    session = SessionProfile(PROFILE_DIR, get_driver, cookie_login, check_url="https://www.tradingview.com/chart/",
+                             require_login=PROFILE_REQUIRE_LOGIN, log=log)
+    if not session.bootstrap() and PROFILE_REQUIRE_LOGIN:
+        log("❌ CHECKPOINT: TradingView session is not logged in (PROFILE_REQUIRE_LOGIN=1)")
         return
 
+    supervisor = DriverSupervisor(DRIVER_MAX_PAGES, DRIVER_MAX_RSS_MB,
+                                  marker=os.path.abspath(PROFILE_DIR) if PROFILE_DIR else "")
+    supervisor.sweep()  # leftovers of an earlier run in this profile dir
+
+    log(f"✅ CHECKPOINT: Timeframes per symbol = {TIMEFRAMES}")
+    if IMAGE_DEDUP:
+        check_hash_column()
+    if IMAGE_FORMAT != "png" or IMAGE_CROP:
+        log(f"✅ CHECKPOINT: Image pipeline format={IMAGE_FORMAT} crop={IMAGE_CROP}"
+            + ("" if Image else " (Pillow missing: storing raw PNG)"))
+
     try:
         creds = json.loads(os.getenv("GSPREAD_CREDENTIALS"))
         gc = gspread.service_account_from_dict(creds)
@@ -520,26 +1376,16 @@ def main():
 
         spreadsheet = gc.open(SPREADSHEET_NAME)
         worksheet = spreadsheet.worksheet(TAB_NAME)
-        all_values = worksheet.get_all_values()
 
-        headers = [h.strip() for h in all_values[0]]
-        df = pd.DataFrame(all_values[1:], columns=headers)
-        df = df.loc[:, ~df.columns.duplicated()].copy()
-        rows = df.to_dict("records")
+        checkpoint = CheckpointManager(CHECKPOINT_FILE, fsync_secs=CHECKPOINT_FSYNC_SECS)
+        already = checkpoint.watermark + 1 + len(checkpoint.done)
 
-        if SHARD_STEP > 1:
-            rows = [r for idx, r in enumerate(rows) if (idx % SHARD_STEP) == SHARD_INDEX]
+        # upper bound only: the grid can hold trailing empty rows
+        total_rows = max(0, (worksheet.row_count - 1 + SHARD_STEP - 1 - SHARD_INDEX) // max(1, SHARD_STEP) - already)
 
-        last_done = read_checkpoint()
-        start_from = last_done + 1
-
-        rows_indexed = list(enumerate(rows))
-        rows_indexed = [t for t in rows_indexed if t[0] >= start_from]
-
-        total_rows = len(rows_indexed)
-
-        log(f"✅ CHECKPOINT: Main rows loaded = {len(rows)} (raw), to-run = {total_rows} (resume from last_done={last_done})")
-        log(f"✅ CHECKPOINT: Sample main row = {rows[0] if rows else 'EMPTY'}")
+        log(f"✅ CHECKPOINT: Main tab has <= {total_rows} rows to run (resume: watermark={checkpoint.watermark}, "
+            f"+{len(checkpoint.done)} done above it), "
+            f"streamed {SHEET_PAGE_ROWS} rows per read")
 
     except Exception as e:
         log(f"❌ CHECKPOINT: GOOGLE SHEETS ERROR: {repr(e)}")
@@ -549,26 +1395,89 @@ def main():
         log("⚠️ CHECKPOINT: Nothing to process (total_rows=0). Check shard/checkpoint.")
         return
 
-    log(f"ℹ️ CHECKPOINT: Starting ThreadPool MAX_THREADS={MAX_THREADS}")
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        futures = [executor.submit(process_row, t) for t in rows_indexed]
-        for f in concurrent.futures.as_completed(futures):
-            try:
-                f.result()
-            except Exception as e:
-                log(f"🔥 THREAD CRASH: {repr(e)}")
-
-    with drivers_lock:
-        for d in all_drivers:
+    if EXEC_MODE == "process":
+        log(f"ℹ️ CHECKPOINT: Starting {MAX_THREADS} worker processes (EXEC_MODE=process)"
+            + (", ADAPTIVE_THREADS ignored" if ADAPTIVE_THREADS else ""))
+    else:
+        controller = ConcurrencyController(MIN_THREADS, MAX_THREADS, START_THREADS, adaptive=ADAPTIVE_THREADS,
+                                           interval=ADAPT_INTERVAL, min_rows=ADAPT_MIN_ROWS)
+        log(f"ℹ️ CHECKPOINT: Starting ThreadPool MAX_THREADS={MAX_THREADS}"
+            + (f" (adaptive {MIN_THREADS}-{MAX_THREADS}, start {START_THREADS})" if ADAPTIVE_THREADS else ""))
+        start_row_pipeline(MAX_THREADS)
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    if EXEC_MODE == "process":
+        tasks = multiprocessing.get_context("fork").Queue(maxsize=max(1, ROW_QUEUE_SIZE))
+    else:
+        tasks = queue.Queue(maxsize=max(1, ROW_QUEUE_SIZE))
+    produced = [0]
+
+    def producer():
+        try:
+            for t in iter_tasks(worksheet):
+                while not stop_event.is_set():
+                    try:
+                        tasks.put(t, timeout=0.5)
+                        produced[0] += 1
+                        break
+                    except queue.Full:
+                        continue
+                if stop_event.is_set():
+                    break
+        except Exception as e:
+            log(f"❌ CHECKPOINT: GOOGLE SHEETS ERROR while streaming rows: {repr(e)}")
+        if stop_event.is_set():
+            # drop rows nobody has started, so the workers see their sentinels
             try:
-                d.quit()
-            except:
+                while True:
+                    tasks.get_nowait()
+            except queue.Empty:
                 pass
-
-    log("\n🏁 COMPLETED.")
-    log(f"📊 SUMMARY: processed={processed_count}, db_ok={db_ok}, db_fail={db_fail}, selenium_fail={selenium_fail}, skipped_no_date={skipped_no_date}, skipped_bad_row={skipped_bad_row}")
-    log(f"🧾 Checkpoint file used: {CHECKPOINT_FILE}")
+        for _ in range(MAX_THREADS):
+            tasks.put(None)
+
+    feeder = threading.Thread(target=producer, name="row-producer", daemon=True)
+    if EXEC_MODE == "process":
+        db_totals = {"batches": 0, "rows_ok": 0, "rows_fail": 0}
+        run_processes(tasks, feeder, db_totals)
+        feeder.join(timeout=5)
+    else:
+        feeder.start()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
+            pending = {executor.submit(run_worker, tasks) for _ in range(MAX_THREADS)}
+            while pending:  # short waits keep the main thread responsive to signals
+                check_deadline()
+                _, pending = concurrent.futures.wait(pending, timeout=1.0)
+        feeder.join(timeout=5)
+        stop_row_pipeline()
+        db_totals = {"batches": db_writer.batches, "rows_ok": db_writer.rows_ok, "rows_fail": db_writer.rows_fail}
+
+    checkpoint.close()
+    metrics.close()  # also writes PROM_TEXTFILE
+
+    supervisor.close()
+
+    log("\n🛑 STOPPED EARLY (signal/deadline): in-flight rows were saved." if stop_event.is_set() else "\n🏁 COMPLETED.")
+    log(f"📥 ROWS: streamed={produced[0]} into a queue of {max(1, ROW_QUEUE_SIZE)}")
+    log(f"📊 SUMMARY: processed={counts['processed']}, db_ok={counts['db_ok']}, db_fail={counts['db_fail']}, selenium_fail={counts['selenium_fail']}, skipped_no_date={counts['skipped_no_date']}, skipped_bad_row={counts['skipped_bad_row']}")
+    log(f"🗄️ DB WRITER: batches={db_totals['batches']}, rows_ok={db_totals['rows_ok']}, rows_fail={db_totals['rows_fail']}")
+    log(f"🖼️ IMAGES: skipped_same={counts['skipped_same']}, raw={counts['bytes_raw']/1e6:.1f}MB -> stored={counts['bytes_stored']/1e6:.1f}MB ({IMAGE_FORMAT})")
+    if ADAPTIVE_THREADS and EXEC_MODE != "process":
+        log(f"🎛️ CONCURRENCY: final limit={controller.limit}, peak={controller.peak}, "
+            f"range {MIN_THREADS}-{MAX_THREADS}, {controller.decisions} changes")
+    log(f"🧭 DRIVERS: {supervisor.summary()} (limits: {DRIVER_MAX_PAGES} charts, {DRIVER_MAX_RSS_MB}MB)")
+    pages = metrics.counters["pages"]
+    if pages:
+        log(f"📦 TRAFFIC: {metrics.counters['requests']/pages:.0f} req, {metrics.counters['bytes']/pages/1024:.0f}KB per page "
+            f"over {pages} pages ({len(BLOCK_URLS)} blocked URL patterns)")
+    log(f"⏱️ STAGES ({METRICS_FILE or 'no JSON lines'}):")
+    for line in metrics.summary_lines():
+        log(f"   {line}")
+    if PRELOAD_NEXT:
+        log(f"🗂️ PRELOAD: {counts['preload_hits']} charts opened from a preloaded tab")
+    log(f"🧾 Checkpoint file used: {CHECKPOINT_FILE} (watermark={checkpoint.watermark}, sparse={len(checkpoint.done)})")
 
 
 if __name__ == "__main__":
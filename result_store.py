@@ -0,0 +1,82 @@
+"""
+Local SQLite store of scrape results for run_scraper.py.
+
+One record per (symbol, url, run_date) holds the 14 values, the outcome and
+whether the row has been acknowledged by Sheet5. A relaunched run only
+scrapes rows that are missing or failed, and replays stored results that
+never reached the sheet. Unlike a single-integer checkpoint, this also
+covers the holes left by failed rows.
+"""
+import json, time, sqlite3
+
+OK = "ok"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    symbol     TEXT    NOT NULL,
+    url        TEXT    NOT NULL,
+    run_date   TEXT    NOT NULL,
+    row_index  INTEGER NOT NULL,
+    vals       TEXT    NOT NULL,
+    status     TEXT    NOT NULL,
+    attempts   INTEGER NOT NULL DEFAULT 0,
+    error      TEXT    NOT NULL DEFAULT '',
+    written    INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL    NOT NULL,
+    PRIMARY KEY (symbol, url, run_date)
+)
+"""
+
+
+class ResultStore:
+    """Used from a single thread (run_scraper's main loop)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def get(self, symbol, url, run_date):
+        cur = self.db.execute(
+            "SELECT vals, status, attempts, error, written FROM results WHERE symbol=? AND url=? AND run_date=?",
+            (symbol, url, run_date))
+        r = cur.fetchone()
+        if r is None:
+            return None
+        return {"vals": json.loads(r[0]), "status": r[1], "attempts": r[2], "error": r[3], "written": bool(r[4])}
+
+    def record(self, symbol, url, run_date, row_index, vals, status, error="", attempts=1):
+        """Stores an outcome; a new result always needs to be (re)written to the sheet."""
+        self.db.execute("""
+            INSERT INTO results (symbol, url, run_date, row_index, vals, status, attempts, error, written, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?)
+            ON CONFLICT (symbol, url, run_date) DO UPDATE SET
+                row_index = excluded.row_index,
+                vals = excluded.vals,
+                status = excluded.status,
+                attempts = results.attempts + excluded.attempts,
+                error = excluded.error,
+                written = 0,
+                updated_at = excluded.updated_at
+        """, (symbol, url, run_date, row_index, json.dumps(vals), status, attempts, error, time.time()))
+        self.db.commit()
+
+    def mark_written(self, keys):
+        """keys = [(symbol, url, run_date), ...] acknowledged by Sheet5."""
+        self.db.executemany("UPDATE results SET written=1 WHERE symbol=? AND url=? AND run_date=?", list(keys))
+        self.db.commit()
+
+    def counts(self, run_date):
+        cur = self.db.execute(
+            "SELECT status, written, COUNT(*) FROM results WHERE run_date=? GROUP BY status, written", (run_date,))
+        return {(s, bool(w)): n for s, w, n in cur.fetchall()}
+
+    def close(self):
+        try:
+            self.db.close()
+        except sqlite3.Error:
+            pass
@@ -1,383 +1,688 @@
-import os, time, json, gspread
+import os, time, json, random, gspread, threading, concurrent.futures
+from collections import Counter
+from urllib.parse import urlparse, parse_qs, unquote
 from datetime import date
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from bs4 import BeautifulSoup
+from selenium.common.exceptions import TimeoutException
+from gspread.exceptions import APIError
 from webdriver_manager.chrome import ChromeDriverManager
 
+from tv_browser import (DriverPool, RateLimiter, SessionProfile, inject_cookies, wait_until_stable,
+                        block_urls_from_env, install_resource_filter, page_traffic)
+from shard_manifest import assign_rows, write_manifest
+from sheet_cache import get_ranges_cached
+from tv_metrics import Metrics
+from result_store import ResultStore, OK, FAILED
+
 # ---------------- CONFIG ---------------- #
 STOCK_LIST_URL = "https://docs.google.com/spreadsheets/d/1V8DsH-R3vdUbXqDKZYWHk_8T0VRjqTEVyj7PhlIDtG4/edit?gid=0#gid=0"
 NEW_MV2_URL    = "https://docs.google.com/spreadsheets/d/1GKlzomaK4l_Yh8pzVtzucCogWW5d-ikVeqCxC6gvBuc/edit?gid=0#gid=0"
 
-# SIMPLE RANGE (REMOVED SHARDING CONFUSION!)
 START_INDEX = int(os.getenv("START_INDEX", "0"))
 END_INDEX   = int(os.getenv("END_INDEX", "2500"))
-CHECKPOINT_FILE = os.getenv("CHECKPOINT_FILE", "checkpoint.txt")
 
-# Resume from checkpoint
-last_i = START_INDEX
-if os.path.exists(CHECKPOINT_FILE):
-    with open(CHECKPOINT_FILE, "r") as f:
-        try:
-            last_i = int(f.read().strip())
-        except:
-            pass
-
-print(f"🔧 Range: {START_INDEX}-{END_INDEX} | Resume: {last_i}")
-
-# ---------------- GOOGLE SHEETS AUTH ---------------- #
-try:
-    creds_json = os.getenv("GSPREAD_CREDENTIALS")
-    if creds_json:
-        client = gspread.service_account_from_dict(json.loads(creds_json))
-    else:
-        client = gspread.service_account(filename="credentials.json")
-        
-    source_sheet = client.open_by_url(STOCK_LIST_URL).worksheet("Sheet1")
-    dest_sheet   = client.open_by_url(NEW_MV2_URL).worksheet("Sheet5")
-    data_rows = source_sheet.get_all_values()[1:]  # Skip header
-    print("✅ Connected. Reading Sheet1, Writing Sheet5")
-except Exception as e:
-    print(f"❌ Connection Error: {e}")
-    raise
+# Matrix shards split START..END by stride: shard k owns rows START+k, START+k+STEP, ...
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_STEP  = int(os.getenv("SHARD_STEP", "1"))
+
+SHARD_TAG = f"{START_INDEX}_{END_INDEX}_shard{SHARD_INDEX}of{SHARD_STEP}"
+RESULT_STORE    = os.getenv("RESULT_STORE", f"results_{SHARD_TAG}.sqlite")  # replaces the old CHECKPOINT_FILE
+MANIFEST_FILE   = os.getenv("MANIFEST_FILE", f"manifest_{SHARD_TAG}.json")
+
+# Browser pool: drivers stay logged in and are recycled after N pages / RSS growth
+DRIVER_MAX_PAGES  = int(os.getenv("DRIVER_MAX_PAGES", "150"))
+DRIVER_MAX_RSS_MB = int(os.getenv("DRIVER_MAX_RSS_MB", "1500"))
+
+# Session: log in once into a Chrome profile and start every driver from a copy ("" = per-driver cookie login)
+PROFILE_DIR           = os.getenv("PROFILE_DIR", ".tv_profile")
+PROFILE_REQUIRE_LOGIN = os.getenv("PROFILE_REQUIRE_LOGIN", "0") == "1"  # abort instead of scraping logged out
+
+# Requests to ads/analytics/social/media hosts are dropped via CDP (see tv_browser.DEFAULT_BLOCK_URLS);
+# BLOCK_URLS="none" disables, "+pattern,..." adds patterns, "pattern,..." replaces the list
+BLOCK_URLS = block_urls_from_env(os.getenv("BLOCK_URLS", ""))
+
+# Instrumentation: one JSON line per symbol with stage timings; optional node_exporter textfile
+METRICS_FILE  = os.getenv("METRICS_FILE", f"metrics_{SHARD_TAG}.jsonl")
+PROM_TEXTFILE = os.getenv("PROM_TEXTFILE", "")
+
+# Concurrency: each worker holds its own pooled driver ("auto" = one per CPU core);
+# page loads toward TradingView are capped globally across all workers
+_workers = os.getenv("SCRAPE_WORKERS", "1").strip().lower()
+SCRAPE_WORKERS = max(1, os.cpu_count() or 1) if _workers == "auto" else max(1, int(_workers))
+MAX_REQUESTS_PER_MIN = float(os.getenv("MAX_REQUESTS_PER_MIN", "30"))
+
+# Readiness: values are read as soon as the legend cells exist and stop changing
+READY_TIMEOUT     = float(os.getenv("READY_TIMEOUT", "40"))
+READY_STABLE_SECS = float(os.getenv("READY_STABLE_SECS", "0.6"))
+
+# Failed rows are retried at the end of the run on fresh drivers, with a growing timeout
+SCRAPE_RETRIES       = int(os.getenv("SCRAPE_RETRIES", "2"))
+RETRY_TIMEOUT_FACTOR = float(os.getenv("RETRY_TIMEOUT_FACTOR", "1.5"))
+
+# Fetch backend: "selenium" (default) or "screener" (bulk HTTP via tradingview-screener,
+# Selenium only for symbols/columns the API can't fill).
+# SCREENER_FIELDS lists one screener column per Sheet5 value column; leave a slot empty
+# for values that only exist in the chart legend, e.g. "close,,RSI,MACD.macd,..."
+FETCH_BACKEND       = os.getenv("FETCH_BACKEND", "selenium").strip().lower()
+SCREENER_FIELDS     = [f.strip() for f in os.getenv("SCREENER_FIELDS", "").split(",")][:14] if os.getenv("SCREENER_FIELDS") else []
+SCREENER_MARKETS    = [m.strip() for m in os.getenv("SCREENER_MARKETS", "").split(",") if m.strip()]
+SCREENER_BATCH      = int(os.getenv("SCREENER_BATCH", "200"))
+SCREENER_DECIMALS   = int(os.getenv("SCREENER_DECIMALS", "2"))
+SCREENER_STUB_FILE   = os.getenv("SCREENER_STUB_FILE", "")    # recorded responses, for offline runs
+SCREENER_RECORD_FILE = os.getenv("SCREENER_RECORD_FILE", "")  # save live responses in stub format
+
+# Sheet5 writer: buffered rows go out as one batch_update when either threshold is hit
+SHEET_FLUSH_ROWS    = int(os.getenv("SHEET_FLUSH_ROWS", "25"))
+SHEET_FLUSH_SECS    = float(os.getenv("SHEET_FLUSH_SECS", "20"))
+SHEET_WRITE_RETRIES = int(os.getenv("SHEET_WRITE_RETRIES", "6"))
+
+# Sheet1 is read for START..END only (columns A:D); snapshots are reused while the sheet is unmodified
+SOURCE_CACHE_DIR = os.getenv("SOURCE_CACHE_DIR", ".sheet_cache")
+SOURCE_CACHE_TTL = float(os.getenv("SOURCE_CACHE_TTL", "0"))  # fallback when modifiedTime is unreadable
 
 current_date = date.today().strftime("%m/%d/%Y")
-CHROME_SERVICE = Service(ChromeDriverManager().install())
+CHROMEDRIVER_PATH = None
+chromedriver_lock = threading.Lock()
+driver_pool = None
+session = None
+rate_limiter = None
+api_values = {}  # row index -> 14 values from the screener, None where Selenium must fill in
+columns_logged = False
+
+metrics = None  # tv_metrics.Metrics: stage timings, per-symbol JSON lines, Prometheus export
 
-# ---------------- YOUR PROVEN SCRAPER (EXACT!) ---------------- #
-def scrape_tradingview(url):
-    if not url:
-        return []
+
+# ---------------- GOOGLE SHEETS ---------------- #
+def connect_sheets():
+    try:
+        creds_json = os.getenv("GSPREAD_CREDENTIALS")
+        if creds_json:
+            client = gspread.service_account_from_dict(json.loads(creds_json))
+        else:
+            client = gspread.service_account(filename="credentials.json")
+
+        source_sheet = client.open_by_url(STOCK_LIST_URL).worksheet("Sheet1")
+        dest_sheet   = client.open_by_url(NEW_MV2_URL).worksheet("Sheet5")
+        # row i of the stock list lives on sheet row i + 2 (header on row 1)
+        [values] = get_ranges_cached(source_sheet, [f"A{START_INDEX+2}:D{END_INDEX+2}"],
+                                     cache_dir=SOURCE_CACHE_DIR, ttl=SOURCE_CACHE_TTL)
+        data_rows = {START_INDEX + k: row + [""] * (4 - len(row)) for k, row in enumerate(values)}
+        print(f"✅ Connected. Read {len(data_rows)} rows of Sheet1, Writing Sheet5")
+        return data_rows, dest_sheet
+    except Exception as e:
+        print(f"❌ Connection Error: {e}")
+        raise
+
+def col_letter(n):
+    """1 -> A, 16 -> P, 27 -> AA"""
+    out = ""
+    while n > 0:
+        n, r = divmod(n - 1, 26)
+        out = chr(ord("A") + r) + out
+    return out
+
+def coalesce_ranges(rows):
+    """{sheet_row: values} -> batch_update payload, one A1 range per run of adjacent rows."""
+    data, run = [], []
+    for r in sorted(rows):
+        if run and r != run[-1] + 1:
+            data.append(run)
+            run = []
+        run.append(r)
+    if run:
+        data.append(run)
+    payload = []
+    for run in data:
+        values = [rows[r] for r in run]
+        width = max(len(v) for v in values)
+        payload.append({"range": f"A{run[0]}:{col_letter(width)}{run[-1]}", "values": values})
+    return payload
+
+def is_retryable(e):
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    return status == 429 or (status is not None and status >= 500)
+
+class SheetWriter:
+    """
+    Buffers Sheet5 rows keyed by target row and writes everything buffered in a
+    single batch_update once flush_rows rows are waiting or the oldest has waited
+    flush_secs. Quota (429) and 5xx errors are retried with jittered exponential
+    backoff. Rows stay buffered until a write is acknowledged, and only then is
+    on_flushed(sheet_rows) called, so callers can advance their checkpoint safely.
+    """
+
+    def __init__(self, ws, flush_rows=25, flush_secs=20.0, max_retries=6, on_flushed=None):
+        self.ws = ws
+        self.flush_rows = flush_rows
+        self.flush_secs = flush_secs
+        self.max_retries = max_retries
+        self.on_flushed = on_flushed
+        self.buffer = {}
+        self.oldest = None
+        self.writes = 0
+        self.rows_written = 0
+
+    def put(self, sheet_row, values):
+        if not self.buffer:
+            self.oldest = time.monotonic()
+        self.buffer[sheet_row] = values
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if not self.buffer:
+            return
+        if len(self.buffer) >= self.flush_rows or time.monotonic() - self.oldest >= self.flush_secs:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return True
+        rows = dict(self.buffer)
+        payload = coalesce_ranges(rows)
+        t0 = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.ws.batch_update(payload)
+                metrics.observe("sheet_write", time.perf_counter() - t0)
+                break
+            except APIError as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    print(f"❌ Write error ({len(rows)} rows kept for next flush): {e}")
+                    self.oldest = time.monotonic()
+                    return False
+                delay = min(64.0, 2.0 ** attempt) * random.uniform(0.5, 1.0)
+                print(f"⏳ Sheets quota/backend error, retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+            except Exception as e:
+                print(f"❌ Write error ({len(rows)} rows kept for next flush): {e}")
+                self.oldest = time.monotonic()
+                return False
+
+        for r in rows:
+            if self.buffer.get(r) is rows[r]:  # not re-buffered meanwhile
+                del self.buffer[r]
+        self.oldest = time.monotonic() if self.buffer else None
+        self.writes += 1
+        self.rows_written += len(rows)
+        print(f"💾 Rows {min(rows)}-{max(rows)}: {len(rows)} rows in {len(payload)} ranges, 1 request")
+        if self.on_flushed:
+            self.on_flushed(sorted(rows))
+        return True
+
+
+# ---------------- BROWSER ---------------- #
+def new_driver(user_data_dir=None):
+    global CHROMEDRIVER_PATH
+    with chromedriver_lock:  # installed on first use: screener-only runs never start Chrome
+        if CHROMEDRIVER_PATH is None:
+            CHROMEDRIVER_PATH = ChromeDriverManager().install()
 
     opts = Options()
     opts.add_argument("--headless=new")
     opts.add_argument("--no-sandbox")
     opts.add_argument("--disable-dev-shm-usage")
-    
-    # YOUR STEALTH OPTIONS (EXACT)
+    opts.add_argument("--disable-gpu")
+    opts.add_argument("--window-size=1920,1080")
     opts.add_argument("--disable-blink-features=AutomationControlled")
     opts.add_experimental_option("excludeSwitches", ["enable-automation"])
-    opts.add_experimental_option("useAutomationExtension", False)
+    opts.add_experimental_option('useAutomationExtension', False)
     opts.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36")
+    if user_data_dir:
+        opts.add_argument(f"--user-data-dir={os.path.abspath(user_data_dir)}")
 
-    driver = webdriver.Chrome(service=CHROME_SERVICE, options=opts)
+    # one Service per driver: a shared Service object only tracks the last chromedriver it started
+    driver = webdriver.Chrome(service=Service(CHROMEDRIVER_PATH), options=opts)
     driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-
+    install_resource_filter(driver, BLOCK_URLS)
+    driver.set_page_load_timeout(60)
+    return driver
+
+def login_driver(driver):
+    """Cookie login: once into the session profile, or once per pooled driver as fallback."""
+    if not os.path.exists("cookies.json"):
+        return
+    driver.get("https://www.tradingview.com/")
+    with open("cookies.json", "r") as f:
+        cookies = json.load(f)
+    inject_cookies(driver, cookies[:15])
+    driver.refresh()
+    WebDriverWait(driver, 20).until(lambda d: d.execute_script("return document.readyState") == "complete")
+    print("  🍪 Driver logged in")
+
+VALUES_PROBE_JS = """
+    const els = document.querySelectorAll(".valueValue-l31H9iuA");
+    return Array.from(els, e => e.textContent).join("\\u0001");
+"""
+
+def wait_values_ready(driver, symbol_name, timeout=READY_TIMEOUT):
+    """
+    Returns as soon as the legend value cells are present and their text has
+    not changed for READY_STABLE_SECS; raises TimeoutException if none show up
+    within timeout.
+    """
+    text, waited, settled = wait_until_stable(
+        lambda: driver.execute_script(VALUES_PROBE_JS),
+        timeout=timeout, stable_for=READY_STABLE_SECS, interval=0.15,
+    )
+    if not text:
+        raise TimeoutException(f"no values after {timeout:g}s")
+    if not settled:
+        metrics.count("ready_unsettled")
+    print(f"  ⏱️ {symbol_name[:20]} ready in {waited:.2f}s{'' if settled else ' (still changing)'}")
+    return waited
+
+# ---------------- SCREENER BACKEND ---------------- #
+def url_to_ticker(url):
+    """'.../chart/x/?symbol=NSE%3AINFY' or '.../symbols/NSE-INFY/' -> 'NSE:INFY'."""
+    if not url:
+        return ""
+    u = urlparse(url)
+    sym = parse_qs(u.query).get("symbol", [""])[0]
+    if sym:
+        return unquote(sym).upper()
+    parts = [p for p in u.path.split("/") if p]
+    if len(parts) >= 2 and parts[0] == "symbols" and "-" in parts[1]:
+        return parts[1].replace("-", ":", 1).upper()
+    return ""
+
+def format_api_value(v):
+    if v is None or v != v:  # None / NaN
+        return None
+    if isinstance(v, float):
+        return f"{v:.{SCREENER_DECIMALS}f}"
+    return str(v)
+
+def load_cookie_dict():
     try:
-        # YOUR COOKIES LOGIC (EXACT)
-        if os.path.exists("cookies.json"):
-            driver.get("https://www.tradingview.com/")
-            with open("cookies.json", "r") as f:
-                for c in json.load(f):
-                    try:
-                        driver.add_cookie({
-                            "name": c.get("name"),
-                            "value": c.get("value"),
-                            "domain": c.get("domain", ".tradingview.com"),
-                            "path": c.get("path", "/")
-                        })
-                    except:
-                        pass
-            driver.refresh()
-
-        driver.get(url)
-        
-        # YOUR PROVEN XPATH (EXACT!)
-        WebDriverWait(driver, 40).until(
-            EC.visibility_of_element_located((
-                By.XPATH,
-                '/html/body/div[2]/div/div[5]/div/div[1]/div/div[2]/div[1]/div[2]/div/div[1]/div[2]/div[2]/div[2]/div[2]/div'
-            ))
-        )
-        
-        time.sleep(2)  # YOUR TIMING
-
-        # YOUR EXACT SELECTOR (WORKS!)
-        soup = BeautifulSoup(driver.page_source, "html.parser")
-        return [
-            el.get_text()
-              .replace('−', '-')
-              .replace('∅', '')
-              .strip()
-            for el in soup.find_all(
-                "div",
-                class_="valueValue-l31H9iuA apply-common-tooltip"
-            )
-        ]
-
-    except Exception as e:
-        print(f"⚠️ Scrape Fail: {e}")
-        return []
-
-    finally:
-        driver.quit()
-
-# ---------------- YOUR PROVEN MAIN LOOP ---------------- #
-batch, batch_start = [], None
-
-print(f"\n🚀 Processing Rows {START_INDEX+2}-{END_INDEX+2}")
-
-for i, row in enumerate(data_rows):  # i starts at 0
-    # SIMPLE RANGE (NO SHARDING!)
-    if i < last_i or i < START_INDEX or i > END_INDEX:
-        continue
-
-    name = row[0]
-    url  = row[3] if len(row) > 3 else ""
-    target_row = i + 2  # YOUR PERFECT MAPPING
-
-    if batch_start is None:
-        batch_start = target_row
-
-    print(f"🔎 [{i}] {name} -> Row {target_row}")
-
-    # YOUR PROVEN SCRAPER
-    vals = scrape_tradingview(url)
-    row_data = [name, current_date] + (vals if vals else ["Error"] * 6)
-    batch.append(row_data)
-
-    # YOUR BATCH LOGIC (EXACT)
-    if len(batch) >= 5:
+        with open("cookies.json", "r") as f:
+            return {c.get("name"): c.get("value") for c in json.load(f)}
+    except:
+        return None
+
+def screener_query(tickers, fields):
+    """Returns {ticker: {field: value}} for one batch of tickers."""
+    from tradingview_screener import Query
+    q = Query().select(*fields).set_tickers(*tickers).limit(len(tickers))
+    if SCREENER_MARKETS:
+        q = q.set_markets(*SCREENER_MARKETS)
+    _, df = q.get_scanner_data(cookies=load_cookie_dict())
+    return {rec["ticker"].upper(): {f: rec.get(f) for f in fields} for rec in df.to_dict("records")}
+
+def fetch_screener_values(rows_by_index):
+    """
+    Bulk-fetches SCREENER_FIELDS for the given {row_index: sheet_row} and maps
+    them onto the 14 Sheet5 value columns. Columns the API doesn't provide (or
+    returned empty) stay None so the Selenium path fills them in.
+    """
+    fields = [f for f in SCREENER_FIELDS if f]
+    if not fields:
+        print("⚠️ FETCH_BACKEND=screener but SCREENER_FIELDS is empty; using Selenium only")
+        return {}
+
+    tickers = {}
+    for i, row in rows_by_index.items():
+        t = url_to_ticker(row[3] if len(row) > 3 else "")
+        if t:
+            tickers[i] = t
+
+    stub = None
+    if SCREENER_STUB_FILE:
+        with open(SCREENER_STUB_FILE, "r") as f:
+            stub = {k.upper(): v for k, v in json.load(f).items()}
+
+    unique = sorted(set(tickers.values()))
+    data = {}
+    for n in range(0, len(unique), SCREENER_BATCH):
+        chunk = unique[n:n + SCREENER_BATCH]
         try:
-            dest_sheet.update(f"A{batch_start}", batch)
-            print(f"💾 Saved rows {batch_start} to {target_row}")
-            batch, batch_start = [], None
-            time.sleep(2)
+            if stub is not None:
+                data.update({t: stub[t] for t in chunk if t in stub})
+            else:
+                with metrics.timed("screener_batch"):
+                    data.update(screener_query(chunk, fields))
         except Exception as e:
-            print(f"❌ Write Error: {e}")
-
-    # YOUR CHECKPOINT (EXACT)
-    with open(CHECKPOINT_FILE, "w") as f:
-        f.write(str(i + 1))
-
-    time.sleep(1)  # YOUR DELAY
-
-# YOUR FINAL FLUSH (EXACT)
-if batch:
-    dest_sheet.update(f"A{batch_start}", batch)
-
-print("\n🏁 Process finished.")
-import os, time, json, gspread
-from datetime import date
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
-from bs4 import BeautifulSoup
-from webdriver_manager.chrome import ChromeDriverManager
-import re
-
-# ---------------- CONFIG ---------------- #
-STOCK_LIST_URL = "https://docs.google.com/spreadsheets/d/1V8DsH-R3vdUbXqDKZYWHk_8T0VRjqTEVyj7PhlIDtG4/edit?gid=0#gid=0"
-NEW_MV2_URL    = "https://docs.google.com/spreadsheets/d/1GKlzomaK4l_Yh8pzVtzucCogWW5d-ikVeqCxC6gvBuc/edit?gid=0#gid=0"
+            print(f"⚠️ Screener batch {n}-{n + len(chunk)} failed, Selenium will cover it: {e}")
+
+    if SCREENER_RECORD_FILE and stub is None:
+        with open(SCREENER_RECORD_FILE, "w") as f:
+            json.dump(data, f, default=str)
+
+    out = {}
+    for i, t in tickers.items():
+        rec = data.get(t)
+        if rec is None:
+            continue
+        vals = [format_api_value(rec.get(f)) if f else None for f in SCREENER_FIELDS]
+        out[i] = vals + [None] * (14 - len(vals))
+
+    complete = sum(1 for v in out.values() if None not in v)
+    print(f"⚡ Screener: {len(out)}/{len(rows_by_index)} symbols returned, {complete} complete without a browser")
+    return out
+
+
+# ---------------- EXTRACTION ---------------- #
+# Collects every visible legend value with its labels and position in one
+# execute_script call; returned as a JSON string to keep decoding cheap.
+EXTRACT_JS = """
+    const out = [];
+    let cells = document.querySelectorAll(".valueValue-l31H9iuA");
+    if (!cells.length) cells = document.querySelectorAll("div[class*='valueValue']");
+    cells.forEach((el, idx) => {
+        const r = el.getBoundingClientRect();
+        if (!r.width && !r.height) return;
+        const item = el.closest("[data-name='legend-source-item'], [class*='item-']");
+        const src = item && item.querySelector("[data-name='legend-source-title'], [class*='title-']");
+        const wrap = el.parentElement;
+        const title = wrap && wrap.querySelector("[class*='valueTitle']");
+        out.push({
+            idx: idx,
+            text: el.textContent,
+            source: src ? src.textContent : "",
+            title: title ? title.textContent : "",
+            x: Math.round(r.left),
+            y: Math.round(r.top)
+        });
+    });
+    return JSON.stringify(out);
+"""
+
+def clean_value(text):
+    return (text or "").replace('−', '-').replace('∅', '').strip()
+
+def order_cells(cells):
+    """Top-to-bottom, left-to-right; DOM order breaks ties."""
+    return sorted(cells, key=lambda c: (c.get("y", 0), c.get("x", 0), c.get("idx", 0)))
+
+def map_values(cells, width=14):
+    """
+    Maps extracted legend cells onto the Sheet5 value columns.
+    Cells are kept as-is, including repeated values, so each column always
+    holds the same legend slot. Missing slots are padded with "N/A".
+    """
+    values = [clean_value(c.get("text")) for c in order_cells(cells)][:width]
+    return values + ["N/A"] * (width - len(values))
+
+def column_labels(cells, width=14):
+    return [f"{c.get('source', '').strip()} {c.get('title', '').strip()}".strip() or "?"
+            for c in order_cells(cells)[:width]]
 
-START_INDEX = int(os.getenv("START_INDEX", "0"))
-END_INDEX   = int(os.getenv("END_INDEX", "2500"))
-CHECKPOINT_FILE = os.getenv("CHECKPOINT_FILE", "checkpoint.txt")
-
-# Resume from checkpoint
-last_i = START_INDEX
-if os.path.exists(CHECKPOINT_FILE):
-    try:
-        with open(CHECKPOINT_FILE, "r") as f:
-            last_i = int(f.read().strip())
-    except:
-        pass
-
-print(f"🔧 Range: {START_INDEX}-{END_INDEX} | Resume: {last_i}")
-
-# ---------------- GOOGLE SHEETS ---------------- #
-try:
-    creds_json = os.getenv("GSPREAD_CREDENTIALS")
-    if creds_json:
-        client = gspread.service_account_from_dict(json.loads(creds_json))
-    else:
-        client = gspread.service_account(filename="credentials.json")
-        
-    source_sheet = client.open_by_url(STOCK_LIST_URL).worksheet("Sheet1")
-    dest_sheet   = client.open_by_url(NEW_MV2_URL).worksheet("Sheet5")
-    data_rows = source_sheet.get_all_values()[1:]
-    print(f"✅ Connected. Processing {END_INDEX-START_INDEX+1} symbols")
-except Exception as e:
-    print(f"❌ Connection Error: {e}")
-    raise
-
-current_date = date.today().strftime("%m/%d/%Y")
-CHROME_SERVICE = Service(ChromeDriverManager().install())
 
 # ---------------- ALL 14 VALUES SCRAPER ---------------- #
-def scrape_tradingview(url, symbol_name):
+class ScrapeFailed(Exception):
+    """No values for this symbol; the row goes to the retry queue instead of the sheet."""
+
+def scrape_tradingview(url, symbol_name, timeout=READY_TIMEOUT, row=None):
+    global columns_logged
     if not url:
         print(f"  ❌ No URL for {symbol_name}")
         return [""] * 14  # 14 empty values
-    
-    opts = Options()
-    opts.add_argument("--headless=new")
-    opts.add_argument("--no-sandbox")
-    opts.add_argument("--disable-dev-shm-usage")
-    opts.add_argument("--disable-gpu")
-    opts.add_argument("--window-size=1920,1080")
-    opts.add_argument("--disable-blink-features=AutomationControlled")
-    opts.add_experimental_option("excludeSwitches", ["enable-automation"])
-    opts.add_experimental_option('useAutomationExtension', False)
-    opts.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36")
-    
-    driver = webdriver.Chrome(service=CHROME_SERVICE, options=opts)
-    driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-    
+
+    rec = metrics.record(symbol_name, row=row)
+    status = "ok"
+    with rec.stage("driver_acquire"):
+        driver = driver_pool.acquire()
+    broken = False
+
     try:
         print(f"  🌐 {symbol_name[:20]}...")
-        
-        # Cookies
-        if os.path.exists("cookies.json"):
-            driver.get("https://www.tradingview.com/")
-            with open("cookies.json", "r") as f:
-                cookies = json.load(f)
-                for c in cookies[:15]:
-                    try:
-                        driver.add_cookie({
-                            "name": c.get("name"), "value": c.get("value"),
-                            "domain": c.get("domain", ".tradingview.com"), 
-                            "path": c.get("path", "/")
-                        })
-                    except: pass
-            driver.refresh()
-            time.sleep(4)
-        
-        driver.set_page_load_timeout(60)
-        driver.get(url)
-        time.sleep(6)  # Full JS render
-        
-        # **ALL 14 VALUES - MULTIPLE STRATEGIES**
-        all_values = []
-        
-        # Strategy 1: Primary value classes (grab ALL)
-        selectors = [
-            ".valueValue-l31H9iuA.apply-common-tooltip",
-            ".valueValue-l31H9iuA",
-            "div[class*='valueValue']",
-            "div[class*='value']",
-            ".chart-markup-table .value",
-            "[data-value]"
-        ]
-        
-        for selector in selectors:
-            try:
-                elements = driver.find_elements(By.CSS_SELECTOR, selector)
-                if elements:
-                    values = []
-                    for el in elements[:20]:  # Grab up to 20
-                        text = el.text.strip().replace('−', '-').replace('∅', '')
-                        if text and len(text) < 25:  # Valid value
-                            values.append(text)
-                    all_values.extend(values)
-                    print(f"  ✅ Selector '{selector}': {len(values)} values")
-            except:
-                continue
-        
-        # Strategy 2: Numeric text extraction
-        soup = BeautifulSoup(driver.page_source, "html.parser")
-        numeric_divs = soup.find_all('div', string=re.compile(r'[\d,.-]+'))
-        for div in numeric_divs[:15]:
-            text = div.get_text().strip().replace('−', '-')
-            if re.match(r'^[\d,.-]+.*|.*[\d,.-]+$', text) and len(text) < 25:
-                if text not in all_values:
-                    all_values.append(text)
-        
-        # Strategy 3: Table cells
-        tables = soup.find_all('table')
-        for table in tables[:3]:
-            for cell in table.find_all(['td', 'th'])[:20]:
-                text = cell.get_text().strip().replace('−', '-')
-                if re.match(r'[\d,.-]', text) and len(text) < 25 and text not in all_values:
-                    all_values.append(text)
-        
-        # Deduplicate + Clean
-        unique_values = []
-        for val in all_values:
-            if val and len(val) > 0 and len(val) < 30 and val not in unique_values:
-                unique_values.append(val)
-        
-        # Pad to exactly 14 columns
-        final_values = unique_values[:14]
-        while len(final_values) < 14:
-            final_values.append("N/A")
-        
-        print(f"  📊 {len(unique_values)} unique → {final_values[:3]}...")
+
+        with rec.stage("rate_wait"):
+            rate_limiter.acquire()
+        with rec.stage("page_load"):
+            driver.get(url)
+        with rec.stage("ready"):
+            wait_values_ready(driver, symbol_name, timeout)
+
+        # ALL 14 VALUES: one round trip, mapped to columns in Python
+        with rec.stage("extract"):
+            cells = json.loads(driver.execute_script(EXTRACT_JS) or "[]")
+            final_values = map_values(cells)
+
+        if cells and not columns_logged:
+            columns_logged = True
+            print(f"  🏷️ Columns: {' | '.join(column_labels(cells))}")
+
+        reqs, nbytes = page_traffic(driver)
+        metrics.count("pages")
+        metrics.count("requests", reqs)
+        metrics.count("bytes", nbytes)
+        rec.fields.update(requests=reqs, bytes=nbytes)
+        print(f"  📊 {len(cells)} cells → {final_values[:3]}... ({reqs} req, {nbytes/1024:.0f}KB)")
         return final_values
-        
-    except TimeoutException:
+
+    except TimeoutException as e:
         print(f"  ⏰ Timeout")
-        return ["N/A"] * 14
+        status = "timeout"
+        raise ScrapeFailed(f"timeout after {timeout:g}s") from e
     except Exception as e:
         print(f"  ❌ Error: {e}")
-        return ["N/A"] * 14
+        status = "error"
+        broken = True  # unknown state (crashed tab, dead session): don't hand it out again
+        raise ScrapeFailed(f"{type(e).__name__}: {str(e).splitlines()[0][:120] if str(e) else ''}") from e
     finally:
-        driver.quit()
-
-# ---------------- MAIN LOOP ---------------- #
-batch = []
-batch_start = None
-processed = success_count = 0
+        driver_pool.release(driver, broken=broken)
+        metrics.count(f"scrape_{status}")
+        metrics.emit(rec, status=status)
 
-print(f"\n🚀 Scraping {END_INDEX-START_INDEX+1} symbols → 14 columns each")
 
-for i, row in enumerate(data_rows):
-    if i < last_i or i < START_INDEX or i > END_INDEX:
-        continue
-    
+# ---------------- MAIN LOOP ---------------- #
+def scrape_row(i, row, timeout=READY_TIMEOUT):
+    """Returns (name, values, None) or (name, None, failure_reason)."""
     name = row[0].strip()
     url = row[3] if len(row) > 3 else ""
-    target_row = i + 2
-    
-    if batch_start is None:
-        batch_start = target_row
-    
-    print(f"[{i+1:4d}/{END_INDEX-START_INDEX+1}] {name[:25]} -> Row {target_row}")
-    
-    # Get ALL 14 values
-    vals = scrape_tradingview(url, name)
-    row_data = [name, current_date] + vals  # ALL 14 columns!
-    
-    if any(v != "N/A" for v in vals):
-        success_count += 1
-    
-    batch.append(row_data)
-    processed += 1
-    
-    # Batch write (5 rows × 16 columns)
-    if len(batch) >= 5:
-        try:
-            dest_sheet.update(f"A{batch_start}", batch)
-            print(f"💾 Rows {batch_start}-{target_row} (5×16 cols)")
-            batch = []
-            batch_start = None
-            time.sleep(2)
-        except Exception as e:
-            print(f"❌ Write error: {e}")
-    
-    # Checkpoint
-    with open(CHECKPOINT_FILE, "w") as f:
-        f.write(str(i + 1))
-    
-    time.sleep(1.8)
-
-# Final batch
-if batch and batch_start:
+
+    api = api_values.get(i)
+    if api is not None and None not in api:
+        print(f"⚡ [{i}] {name[:25]} -> Row {i + 2} (screener)")
+        return name, api, None
+
+    print(f"🔎 [{i}] {name[:25]} -> Row {i + 2}")
     try:
-        dest_sheet.update(f"A{batch_start}", batch)
-        print(f"💾 Final: Rows {batch_start}-{target_row}")
-    except Exception as e:
-        print(f"❌ Final write: {e}")
+        vals = scrape_tradingview(url, name, timeout, row=i)
+    except ScrapeFailed as e:
+        return name, None, str(e)
+    if api is not None:
+        vals = [a if a is not None else v for a, v in zip(api, vals)]
+    return name, vals, None
+
+def partial_values(i):
+    """The screener values for row i with "N/A" in the gaps, or None if the API had nothing for it."""
+    api = api_values.get(i)
+    if not api or all(a is None for a in api):
+        return None
+    return [a if a is not None else "N/A" for a in api]
+
+def run_pass(rows, data_rows, on_result, timeout=READY_TIMEOUT, tick=None):
+    """
+    Scrapes rows on the worker pool and calls on_result(i, name, vals, error)
+    in row order, however the rows finish. tick() runs at least once a second.
+    """
+    results = {}   # finished rows waiting for the rows before them
+    next_pos = 0   # position in `rows` of the next row to report
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SCRAPE_WORKERS) as executor:
+        todo = iter(rows)
+        pending = {}
+
+        def submit_next():
+            i = next(todo, None)
+            if i is not None:
+                pending[executor.submit(scrape_row, i, data_rows[i], timeout)] = i
+
+        # bounded look-ahead keeps out-of-order results (and memory) small
+        for _ in range(SCRAPE_WORKERS * 2):
+            submit_next()
+
+        while pending:
+            finished, _ = concurrent.futures.wait(pending, timeout=1.0,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in finished:
+                i = pending.pop(f)
+                try:
+                    results[i] = f.result()
+                except Exception as e:
+                    print(f"🔥 Worker crash row {i}: {e}")
+                    results[i] = (data_rows[i][0].strip(), None, f"worker crash: {e}")
+                submit_next()
+
+            while next_pos < len(rows) and rows[next_pos] in results:
+                i = rows[next_pos]
+                on_result(i, *results.pop(i))
+                next_pos += 1
+            if tick:
+                tick()
+
+def main():
+    global driver_pool, rate_limiter, api_values, session, metrics
+
+    metrics = Metrics("run_scraper", jsonl_path=METRICS_FILE, prom_path=PROM_TEXTFILE)
+    assigned = assign_rows(START_INDEX, END_INDEX, SHARD_INDEX, SHARD_STEP)
+    store = ResultStore(RESULT_STORE)
+
+    data_rows, dest_sheet = connect_sheets()
+
+    session = SessionProfile(PROFILE_DIR, new_driver, login_driver, require_login=PROFILE_REQUIRE_LOGIN)
+    if FETCH_BACKEND != "screener":  # screener runs only start Chrome for leftovers, so log in lazily there
+        if not session.bootstrap() and PROFILE_REQUIRE_LOGIN:
+            print("❌ TradingView session is not logged in (PROFILE_REQUIRE_LOGIN=1), aborting")
+            store.close()
+            return
+
+    def spawn_driver():
+        with metrics.timed("driver_start"):
+            return session.new_driver()
+
+    driver_pool = DriverPool(spawn_driver, size=SCRAPE_WORKERS,
+                             max_pages=DRIVER_MAX_PAGES, max_rss_mb=DRIVER_MAX_RSS_MB)
+    rate_limiter = RateLimiter(MAX_REQUESTS_PER_MIN, burst=SCRAPE_WORKERS)
+
+    processed = success_count = replayed = recovered = partial_rows = 0
+    written_rows, failed_rows = set(), set()
+    keys = {}      # row index -> (symbol, url, run_date) result-store key
+    replays = []   # (row index, name, stored values) scraped earlier but never acknowledged by Sheet5
+    failures = {}  # row index -> last failure reason (the deferred retry queue)
+
+    # rows past the end of Sheet1 have nothing to scrape
+    written_rows.update(i for i in assigned if i not in data_rows)
+
+    # Skip rows already scraped and written today; replay stored results that never reached Sheet5
+    todo_rows = []
+    for i in assigned:
+        if i not in data_rows:
+            continue
+        row = data_rows[i]
+        keys[i] = (row[0].strip(), row[3], current_date)
+        prev = store.get(*keys[i])
+        if prev and prev["status"] == OK and prev["written"]:
+            written_rows.add(i)
+        elif prev and prev["status"] == OK:
+            replays.append((i, keys[i][0], prev["vals"]))
+        else:
+            todo_rows.append(i)
+
+    def save_manifest():
+        return write_manifest(MANIFEST_FILE, START_INDEX, END_INDEX, SHARD_INDEX, SHARD_STEP,
+                              assigned, written_rows, set(failed_rows) | set(failures))
+
+    # written now and after every sheet flush, so a killed run still leaves an honest (incomplete) manifest
+    save_manifest()
+
+    total = len(todo_rows)
+    print(f"🔧 Range: {START_INDEX}-{END_INDEX} | Shard {SHARD_INDEX}/{SHARD_STEP} | Done: {len(written_rows)} | Replay: {len(replays)} | To scrape: {total}")
+
+    if FETCH_BACKEND == "screener":
+        api_values = fetch_screener_values({i: data_rows[i] for i in todo_rows})
+
+    print(f"\n🚀 Scraping {total} symbols → 14 columns each | workers={SCRAPE_WORKERS} | ≤{MAX_REQUESTS_PER_MIN:g} pages/min")
+
+    def on_flushed(sheet_rows):
+        rows = [r - 2 for r in sheet_rows if r - 2 not in failures]  # partial rows still count as failed
+        written_rows.update(rows)
+        store.mark_written(keys[i] for i in rows)
+        save_manifest()
+
+    writer = SheetWriter(dest_sheet, flush_rows=SHEET_FLUSH_ROWS, flush_secs=SHEET_FLUSH_SECS,
+                         max_retries=SHEET_WRITE_RETRIES, on_flushed=on_flushed)
+
+    def on_result(i, name, vals, error):
+        nonlocal processed, success_count, recovered
+        target_row = i + 2
+        retry = i in failures
+
+        if vals is None:
+            store.record(*keys[i], i, partial_values(i) or ["N/A"] * 14, FAILED, error)
+            failures[i] = error
+            if not retry:
+                processed += 1
+            print(f"[{processed:4d}/{total}] Row {target_row} {name[:25]} ✖ deferred ({error})")
+            return
+
+        store.record(*keys[i], i, vals, OK)
+        success_count += 1
+        if retry:
+            recovered += 1
+            del failures[i]
+        else:
+            processed += 1
+        print(f"[{processed:4d}/{total}] Row {target_row} {name[:25]}{' (retry ok)' if retry else ''}")
+        writer.put(target_row, [name, current_date] + vals)  # ALL 14 columns!
 
-print(f"\n🎉 COMPLETE!")
-print(f"📊 Processed: {processed} | Success: {success_count}")
-print(f"📍 Sheet5: Rows {START_INDEX+2}-{END_INDEX+2} × 16 columns")
-print(f"✅ Success rate: {success_count/processed*100:.1f}%")
+    try:
+        for i, name, vals in replays:
+            writer.put(i + 2, [name, current_date] + vals)
+            replayed += 1
+
+        run_pass(todo_rows, data_rows, on_result, tick=writer.maybe_flush)
+
+        # Deferred retry queue: fresh drivers and a longer readiness timeout each round
+        for attempt in range(1, SCRAPE_RETRIES + 1):
+            if not failures:
+                break
+            timeout = READY_TIMEOUT * RETRY_TIMEOUT_FACTOR ** attempt
+            print(f"\n🔁 Retry {attempt}/{SCRAPE_RETRIES}: {len(failures)} rows, timeout {timeout:.0f}s, fresh drivers")
+            driver_pool.recycle_idle("retry pass")
+            run_pass(sorted(failures), data_rows, on_result, timeout=timeout, tick=writer.maybe_flush)
+    finally:
+        failed_rows.update(failures)
+
+        # Rows Selenium couldn't finish still get whatever the screener returned
+        for i in sorted(failures):
+            partial = partial_values(i)
+            if partial:
+                writer.put(i + 2, [keys[i][0], current_date] + partial)
+                partial_rows += 1
+
+        # Final flush; a second attempt covers a transient non-quota failure
+        if not writer.flush():
+            time.sleep(5)
+            writer.flush()
+
+        pool_stats = driver_pool.stats()
+        driver_pool.close()
+        store.close()
+        metrics.close()  # also writes PROM_TEXTFILE
+        manifest = save_manifest()
+        print(f"🧾 Manifest {MANIFEST_FILE}: {len(manifest['done'])}/{len(manifest['assigned'])} done, complete={manifest['complete']}")
+
+    print(f"\n🎉 COMPLETE!")
+    print(f"📊 Processed: {processed} | Success: {success_count} ({recovered} after retry) | Failed: {len(failed_rows)} ({partial_rows} written with screener values only) | Replayed from {RESULT_STORE}: {replayed}")
+    for reason, n in Counter(failures.values()).most_common(5):
+        print(f"   ✖ {n}× {reason}")
+    print(f"💾 Sheet writes: {writer.writes} requests for {writer.rows_written} rows ({len(writer.buffer)} unwritten)")
+    print(f"⏱️ Stage timings ({METRICS_FILE or 'no JSON lines'}), ready_unsettled={metrics.counters['ready_unsettled']}:")
+    for line in metrics.summary_lines():
+        print(f"   {line}")
+    pages = metrics.counters["pages"]
+    if pages:
+        print(f"📦 Traffic: {metrics.counters['requests']/pages:.0f} req, {metrics.counters['bytes']/pages/1024:.0f}KB per page "
+              f"over {pages} pages ({len(BLOCK_URLS)} blocked URL patterns)")
+    print(f"🧭 Drivers: created={pool_stats['created']} recycled={pool_stats['recycled']} peak_rss={pool_stats['peak_rss_mb']}MB")
+    print(f"📍 Sheet5: Rows {START_INDEX+2}-{END_INDEX+2} (shard {SHARD_INDEX}/{SHARD_STEP}) × 16 columns")
+    if processed:
+        print(f"✅ Success rate: {success_count/processed*100:.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Per-shard completion manifests for run_scraper.py.
+
+Every shard writes one JSON manifest describing the rows it was assigned and
+the rows it finished. A merge step can then check that the shards of a chunk
+cover START_INDEX..END_INDEX exactly once:
+
+    python shard_manifest.py manifest_*.json
+"""
+import os, sys, json, time
+
+
+def assign_rows(start, end, shard_index=0, shard_step=1):
+    """Deterministic strided assignment of the inclusive range start..end."""
+    if shard_step < 1 or not (0 <= shard_index < shard_step):
+        raise ValueError(f"bad shard {shard_index}/{shard_step}")
+    return [i for i in range(start, end + 1) if (i - start) % shard_step == shard_index]
+
+
+def read_manifest(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(path, start, end, shard_index, shard_step, assigned, done, failed=()):
+    """Atomically (re)writes a shard manifest; rows done in earlier runs are kept."""
+    prev = read_manifest(path) or {}
+    same_shard = (prev.get("start"), prev.get("end"), prev.get("shard_index"), prev.get("shard_step")) == \
+                 (start, end, shard_index, shard_step)
+    done = set(done) | (set(prev.get("done", [])) if same_shard else set())
+    failed = set(failed)
+
+    manifest = {
+        "start": start,
+        "end": end,
+        "shard_index": shard_index,
+        "shard_step": shard_step,
+        "assigned": sorted(assigned),
+        "done": sorted(done & set(assigned)),
+        "failed": sorted(failed & set(assigned)),
+        "complete": set(assigned) <= done,
+        "updated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+    return manifest
+
+
+def verify_manifests(manifests):
+    """
+    Returns a list of problems (empty when every chunk is fully covered).
+    Manifests are grouped by (start, end); within a group the assigned rows
+    must not overlap, must cover the whole range and must all be done.
+    """
+    problems = []
+    groups = {}
+    for m in manifests:
+        groups.setdefault((m["start"], m["end"]), []).append(m)
+
+    for (start, end), shards in sorted(groups.items()):
+        owner = {}
+        for m in shards:
+            for i in m["assigned"]:
+                if i in owner:
+                    problems.append(f"{start}-{end}: row {i} assigned to shards {owner[i]} and {m['shard_index']}")
+                owner[i] = m["shard_index"]
+        missing = sorted(set(range(start, end + 1)) - set(owner))
+        if missing:
+            problems.append(f"{start}-{end}: {len(missing)} rows not assigned to any shard, e.g. {missing[:10]}")
+        for m in sorted(shards, key=lambda m: m["shard_index"]):
+            not_done = sorted(set(m["assigned"]) - set(m["done"]))
+            if not_done:
+                problems.append(f"{start}-{end}: shard {m['shard_index']} left {len(not_done)} rows unfinished, e.g. {not_done[:10]}")
+    return problems
+
+
+def main(paths):
+    manifests = []
+    for p in paths:
+        m = read_manifest(p)
+        if m is None:
+            print(f"❌ Unreadable manifest: {p}")
+            return 1
+        manifests.append(m)
+    if not manifests:
+        print("❌ No manifests given")
+        return 1
+
+    problems = verify_manifests(manifests)
+    for p in problems:
+        print(f"❌ {p}")
+    if problems:
+        return 1
+    rows = sum(len(m["assigned"]) for m in manifests)
+    print(f"✅ {len(manifests)} shard manifests cover {rows} rows with no overlap")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,62 @@
+"""
+On-disk snapshots of Google Sheets ranges.
+
+A snapshot is keyed by spreadsheet id, worksheet id and the requested A1
+ranges, and stores the spreadsheet's Drive modifiedTime. It is reused as long
+as the sheet has not been modified since, so repeated or resumed runs skip
+the Sheets read (and its quota) entirely.
+"""
+import os, json, time, hashlib
+
+
+def sheet_revision(spreadsheet):
+    """Drive modifiedTime of the spreadsheet, None if it can't be read."""
+    for getter in ("get_lastUpdateTime", "lastUpdateTime"):  # gspread 6 / gspread 5
+        try:
+            v = getattr(spreadsheet, getter)
+            v = v() if callable(v) else v
+            if v:
+                return str(v)
+        except Exception:
+            continue
+    return None
+
+
+def _snapshot_path(cache_dir, worksheet, ranges):
+    digest = hashlib.sha1("|".join(ranges).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{worksheet.spreadsheet.id}_{worksheet.id}_{digest}.json")
+
+
+def get_ranges_cached(worksheet, ranges, cache_dir="", ttl=0, log=print):
+    """
+    Returns worksheet.batch_get(ranges) as plain lists, one list of rows per range.
+    With a cache_dir, a snapshot is reused while the sheet's modifiedTime is
+    unchanged; if the revision can't be read, only while it is younger than ttl.
+    """
+    ranges = list(ranges)
+    if not cache_dir:
+        return [[list(r) for r in vr] for vr in worksheet.batch_get(ranges)]
+
+    path = _snapshot_path(cache_dir, worksheet, ranges)
+    revision = sheet_revision(worksheet.spreadsheet)
+    try:
+        with open(path, "r") as f:
+            snap = json.load(f)
+        fresh = (revision is not None and snap.get("revision") == revision) or \
+                (revision is None and ttl > 0 and time.time() - snap.get("fetched_at", 0) < ttl)
+        if fresh and snap.get("ranges") == ranges:
+            log(f"✅ Sheet snapshot hit: {os.path.basename(path)} (rev {revision or 'ttl'})")
+            return snap["values"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    values = [[list(r) for r in vr] for vr in worksheet.batch_get(ranges)]
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"revision": revision, "fetched_at": time.time(), "ranges": ranges, "values": values}, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        log(f"⚠️ Sheet snapshot not saved: {e}")
+    return values
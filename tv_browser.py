@@ -0,0 +1,580 @@
+import os, json, time, queue, atexit, shutil, signal, tempfile, threading
+
+# ---------------- PROCESS TREE (RSS) ---------------- #
+try:
+    PAGE_BYTES = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    PAGE_BYTES = 4096
+
+def _children_map():
+    """ppid -> [pid] for every process visible in /proc (Linux only)."""
+    kids = {}
+    try:
+        pids = [p for p in os.listdir("/proc") if p.isdigit()]
+    except OSError:
+        return kids
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/stat", "r") as f:
+                stat = f.read()
+            # comm may contain spaces, so split after the closing paren
+            ppid = int(stat.rsplit(")", 1)[1].split()[1])
+            kids.setdefault(ppid, []).append(int(p))
+        except (OSError, ValueError, IndexError):
+            continue
+    return kids
+
+def process_tree_pids(root_pid):
+    kids = _children_map()
+    out, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        out.append(pid)
+        stack.extend(kids.get(pid, []))
+    return out
+
+def process_tree_rss_mb(root_pid):
+    """Resident memory of root_pid and all its descendants, None if unknown."""
+    if not root_pid or not os.path.isdir("/proc"):
+        return None
+    total = 0
+    for pid in process_tree_pids(root_pid):
+        try:
+            with open(f"/proc/{pid}/statm", "r") as f:
+                total += int(f.read().split()[1]) * PAGE_BYTES
+        except (OSError, ValueError, IndexError):
+            continue
+    return total / (1024 * 1024)
+
+def mem_available_mb():
+    """MemAvailable from /proc/meminfo in MB, None if unknown."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def driver_root_pid(driver):
+    """PID of the chromedriver process; Chrome and its renderers hang below it."""
+    try:
+        return driver.service.process.pid
+    except Exception:
+        return None
+
+def driver_rss_mb(driver):
+    return process_tree_rss_mb(driver_root_pid(driver))
+
+def _proc_read(pid, name):
+    try:
+        with open(f"/proc/{pid}/{name}", "rb") as f:
+            return f.read().decode(errors="replace")
+    except OSError:
+        return ""
+
+# exact /proc/<pid>/comm names; the kernel truncates comm to 15 characters
+BROWSER_COMMS = {"chromedriver", "chrome", "chromium", "chromium-browse", "chrome_crashpad",
+                 "chrome-headless", "headless_shell"}
+
+def _is_browser(pid):
+    return _proc_read(pid, "comm").strip() in BROWSER_COMMS
+
+def kill_orphan_browsers(keep_roots=(), marker="", log=print):
+    """
+    Kills chromedriver/Chrome trees this process no longer owns:
+    - chromedriver children of this process whose PID isn't in keep_roots (drivers of crashed threads);
+    - Chrome processes re-parented to init whose command line contains marker (e.g. our profile dir).
+    Returns the number of processes killed.
+    """
+    if not os.path.isdir("/proc"):
+        return 0
+    keep = {p for p in keep_roots if p}
+    kids = _children_map()
+    roots = [p for p in kids.get(os.getpid(), []) if p not in keep and _is_browser(p)]
+    if marker:
+        roots += [p for p in kids.get(1, []) if _is_browser(p) and marker in _proc_read(p, "cmdline")]
+    killed = 0
+    for root in roots:
+        for pid in process_tree_pids(root):
+            try:
+                os.kill(pid, signal.SIGKILL)
+                killed += 1
+            except OSError:
+                pass
+        try:
+            os.waitpid(root, os.WNOHANG)  # reap our own child so it doesn't linger as a zombie
+        except OSError:
+            pass
+    if killed:
+        log(f"🧹 Killed {killed} orphaned browser processes ({len(roots)} trees)")
+    return killed
+
+def driver_alive(driver):
+    try:
+        return driver.execute_script("return 1") == 1
+    except Exception:
+        return False
+
+
+# ---------------- DRIVER POOL ---------------- #
+class DriverPool:
+    """
+    Long-lived pool of logged-in Chrome drivers that are reused across symbols.
+
+    factory() builds a bare driver and warmup(driver) logs it in, so the Chrome
+    cold start and the cookie round trip are paid once per driver instead of
+    once per page. On every acquire() the driver is health-checked and recycled
+    when it has served max_pages pages or its process tree grew past max_rss_mb.
+    All drivers are quit on close(), which also runs at interpreter exit.
+    """
+
+    def __init__(self, factory, size=1, warmup=None, max_pages=150, max_rss_mb=1500, log=print):
+        self.factory = factory
+        self.warmup = warmup
+        self.size = max(1, int(size))
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.log = log
+
+        self._idle = queue.LifoQueue()  # LIFO keeps the warmest drivers busy
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._pages = {}                # id(driver) -> pages served
+        self._drivers = {}              # id(driver) -> driver
+        self._closed = False
+
+        self.created = 0
+        self.recycled = 0
+        self.peak_rss_mb = 0.0
+
+        atexit.register(self.close)
+
+    def _spawn(self):
+        d = self.factory()
+        try:
+            if self.warmup:
+                self.warmup(d)
+        except Exception:
+            self._quit(d)
+            raise
+        with self._lock:
+            self._drivers[id(d)] = d
+            self._pages[id(d)] = 0
+            self.created += 1
+        return d
+
+    def _quit(self, d):
+        try:
+            d.quit()
+        except Exception:
+            pass
+
+    def _retire(self, d, reason):
+        with self._lock:
+            self._drivers.pop(id(d), None)
+            pages = self._pages.pop(id(d), 0)
+            self.recycled += 1
+        self.log(f"  ♻️ Recycling driver after {pages} pages ({reason})")
+        self._quit(d)
+
+    def _recycle_reason(self, d):
+        pages = self._pages.get(id(d), 0)
+        if self.max_pages and pages >= self.max_pages:
+            return f"page limit {self.max_pages}"
+        rss = driver_rss_mb(d)
+        if rss is not None:
+            self.peak_rss_mb = max(self.peak_rss_mb, rss)
+            if self.max_rss_mb and rss > self.max_rss_mb:
+                return f"rss {rss:.0f}MB > {self.max_rss_mb}MB"
+        if not driver_alive(d):
+            return "health check failed"
+        return None
+
+    def acquire(self):
+        """Blocks until a slot is free, then returns a healthy, logged-in driver."""
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    d = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._spawn()
+                reason = self._recycle_reason(d)
+                if reason is None:
+                    return d
+                self._retire(d, reason)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, d, broken=False):
+        """Returns a driver to the pool; broken drivers are quit instead."""
+        try:
+            if broken or self._closed:
+                self._retire(d, "broken" if broken else "pool closed")
+            else:
+                with self._lock:
+                    self._pages[id(d)] = self._pages.get(id(d), 0) + 1
+                self._idle.put(d)
+        finally:
+            self._slots.release()
+
+    def recycle_idle(self, reason):
+        """Quits every idle driver so the next acquire() starts a fresh one."""
+        while True:
+            try:
+                d = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._retire(d, reason)
+
+    def stats(self):
+        with self._lock:
+            live = len(self._drivers)
+        return {"live": live, "created": self.created, "recycled": self.recycled,
+                "peak_rss_mb": round(self.peak_rss_mb, 1)}
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        with self._lock:
+            drivers = list(self._drivers.values())
+            self._drivers.clear()
+            self._pages.clear()
+        for d in drivers:
+            self._quit(d)
+
+
+# ---------------- RATE LIMIT ---------------- #
+class RateLimiter:
+    """
+    Global ceiling on page loads across all workers (token bucket).
+    max_per_minute <= 0 disables limiting; burst allows a short catch-up.
+    """
+
+    def __init__(self, max_per_minute, burst=1):
+        self.rate = max_per_minute / 60.0 if max_per_minute and max_per_minute > 0 else 0
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# ---------------- READINESS ---------------- #
+def wait_until_stable(probe, timeout, stable_for=0.5, interval=0.1, ready=bool):
+    """
+    Polls probe() until it returns a ready value that then stays unchanged for
+    stable_for seconds, or until timeout. Returns (value, seconds_waited, settled).
+    Exceptions raised by probe() propagate to the caller.
+    """
+    start = time.monotonic()
+    end = start + timeout
+    last, since = None, None
+    while True:
+        value = probe()
+        now = time.monotonic()
+        if not ready(value):
+            last, since = None, None
+        elif since is None or value != last:
+            last, since = value, now
+        elif now - since >= stable_for:
+            return value, now - start, True
+        if now >= end:
+            return (last if since is not None else value), now - start, False
+        time.sleep(min(interval, max(0.0, end - now)))
+
+
+# ---------------- CHART RENDER PROBE ---------------- #
+LOADER_SELECTORS = [
+    "[data-name='spinner']",
+    "[class*='spinner']",
+    "[class*='loading']",
+    "[class*='progress']",
+    "div[class*='loader']",
+]
+LEGEND_VALUE_SELECTOR = "[data-name='legend-source-item'] div[class*='valueValue']"
+
+# Installs (once per document/root) a MutationObserver that stamps the last DOM change,
+# then reports visible loaders, ms since the last change and the legend values.
+# The observer only sees DOM nodes: the candles are painted on a <canvas>, which fires no
+# mutations, so "quiet" means the legend/overlays settled, not that the last frame was drawn.
+RENDER_PROBE_JS = """
+const root = document.querySelector(arguments[0]) || document.body;
+let w = window.__tvRender;
+if (!w || w.root !== root) {
+  if (w && w.obs) w.obs.disconnect();
+  w = window.__tvRender = {root: root, last: performance.now()};
+  w.obs = new MutationObserver(() => { w.last = performance.now(); });
+  w.obs.observe(root, {subtree: true, childList: true, characterData: true, attributes: true});
+}
+const visible = el => el && el.offsetParent !== null;
+const loading = arguments[1].some(s => Array.from(root.querySelectorAll(s)).some(visible));
+const values = Array.from(root.querySelectorAll(arguments[2])).map(e => (e.textContent || "").trim());
+return JSON.stringify({loading: loading, quiet: performance.now() - w.last, values: values});
+"""
+
+def chart_render_state(driver, root_selector="div[class*='chart-container']"):
+    return json.loads(driver.execute_script(RENDER_PROBE_JS, root_selector, LOADER_SELECTORS, LEGEND_VALUE_SELECTOR))
+
+def wait_chart_rendered(driver, timeout=6.0, quiet_ms=400, root_selector="div[class*='chart-container']", interval=0.1):
+    """
+    Waits until no loader is visible and both the legend values (price + indicators) and
+    the chart's DOM have stopped changing for quiet_ms. Values are not checked for
+    placeholders: at historical dates an indicator can legitimately stay "∅" or "—".
+    One cheap execute_script per poll instead of screenshotting the chart.
+    Returns (seconds_waited, settled).
+    """
+    start = time.monotonic()
+    end = start + timeout
+    values, values_since = None, start
+    while True:
+        st = chart_render_state(driver, root_selector)
+        now = time.monotonic()
+        if st["values"] != values:
+            values, values_since = st["values"], now
+        if not st["loading"] and st["quiet"] >= quiet_ms and (now - values_since) * 1000 >= quiet_ms:
+            return now - start, True
+        if now >= end:
+            return now - start, False
+        time.sleep(min(interval, max(0.0, end - now)))
+
+
+# ---------------- SESSION PROFILE ---------------- #
+# Chrome refuses a user-data-dir whose Singleton* lock files point at another (dead) process;
+# caches are skipped to keep each copy small.
+PROFILE_COPY_IGNORE = shutil.ignore_patterns("Singleton*", "lockfile", "*Cache*", "Crashpad", "*.tmp")
+
+def inject_cookies(driver, cookies, domain=None, persist_days=30):
+    """
+    add_cookie() for every exported cookie on the currently loaded site. An expiry is
+    always set: Chrome only writes persistent cookies to the profile on disk.
+    Returns the number of cookies accepted.
+    """
+    n = 0
+    for c in cookies:
+        cookie = {
+            "name": c.get("name"), "value": c.get("value"),
+            "domain": domain or c.get("domain", ".tradingview.com"),
+            "path": c.get("path", "/"),
+        }
+        exp = c.get("expiry") or c.get("expirationDate")
+        cookie["expiry"] = int(exp) if exp else int(time.time() + persist_days * 86400)
+        if c.get("secure"):
+            cookie["secure"] = True
+        if c.get("httpOnly"):
+            cookie["httpOnly"] = True
+        try:
+            driver.add_cookie(cookie)
+            n += 1
+        except Exception:
+            pass
+    return n
+
+def session_user(driver, timeout=8.0, log=print):
+    """
+    (logged_in, username) for the tradingview.com page currently loaded, decided by the page's
+    own window.user only. A sessionid cookie proves nothing (inject_cookies always sets one,
+    expired or not), so it is only used to explain a failed check.
+    """
+    deadline = time.time() + timeout
+    user = None
+    while True:
+        try:
+            user = driver.execute_script("return (window.user && window.user.username) || null")
+        except Exception:
+            user = None
+        if user and str(user).lower() == "guest":
+            user = None
+        if user or time.time() >= deadline:
+            break
+        time.sleep(0.25)  # window.user is filled in by the page's scripts after load
+    if not user:
+        try:
+            if driver.get_cookie("sessionid") is not None:
+                log("⚠️ sessionid cookie present but the page is logged out (expired cookies?)")
+        except Exception:
+            pass
+    return bool(user), user
+
+class SessionProfile:
+    """
+    Logs in once into a master Chrome profile, then starts every driver from a copy of it,
+    so a new driver is logged in before its first navigation.
+
+    make_driver(user_data_dir) -> driver (user_data_dir may be None)
+    login(driver)                cookie login used for the bootstrap, and per driver as fallback
+    base_dir ""                  disables profiles: every driver logs in itself, as before
+    require_login                raise instead of falling back when the session can't be validated
+    """
+
+    def __init__(self, base_dir, make_driver, login, check_url="https://www.tradingview.com/",
+                 require_login=False, log=print):
+        self.base_dir = base_dir
+        self.make_driver = make_driver
+        self.login = login
+        self.check_url = check_url
+        self.require_login = require_login
+        self.log = log
+        self.master = os.path.join(base_dir, "master") if base_dir else ""
+        self.ok = None        # None = not bootstrapped yet
+        self.username = None
+        self.clones = []
+        self._driver_dirs = {}  # id(driver) -> its profile copy
+        self._lock = threading.Lock()
+        atexit.register(self.cleanup)
+
+    def bootstrap(self):
+        """Logs in once and validates the session; returns True when profile copies can be used."""
+        with self._lock:
+            if self.ok is not None:
+                return self.ok
+            self.ok = False
+            if not self.base_dir:
+                return False
+            shutil.rmtree(self.master, ignore_errors=True)
+            os.makedirs(self.master, exist_ok=True)
+            d = None
+            try:
+                d = self.make_driver(self.master)
+                self.login(d)
+                d.get(self.check_url)
+                self.ok, self.username = session_user(d, log=self.log)
+            except Exception as e:
+                self.log(f"⚠️ Session bootstrap failed: {repr(e)[:200]}")
+            finally:
+                if d is not None:
+                    try:
+                        d.quit()  # a clean shutdown flushes the cookie store to disk
+                    except Exception:
+                        pass
+            if self.ok:
+                self.log(f"✅ Session profile ready ({self.username}) -> {self.master}")
+            else:
+                self.log("⚠️ Session not logged in: drivers will log in one by one")
+            return self.ok
+
+    def clone(self):
+        path = tempfile.mkdtemp(prefix="driver_", dir=self.base_dir)
+        os.rmdir(path)  # copytree wants to create it
+        shutil.copytree(self.master, path, ignore=PROFILE_COPY_IGNORE)
+        with self._lock:
+            self.clones.append(path)
+        return path
+
+    def new_driver(self):
+        """A logged-in driver: from a profile copy when possible, else a fresh cookie login."""
+        if self.bootstrap():
+            path = self.clone()
+            try:
+                d = self.make_driver(path)
+            except Exception:
+                self._drop_clone(path)
+                raise
+            with self._lock:
+                self._driver_dirs[id(d)] = path
+            return d
+        if self.require_login:
+            raise RuntimeError("TradingView session is not logged in")
+        d = self.make_driver(None)
+        try:
+            self.login(d)
+        except Exception:
+            try:
+                d.quit()
+            except Exception:
+                pass
+            raise
+        return d
+
+    def release(self, driver):
+        """Removes the profile copy of a driver that has been quit."""
+        with self._lock:
+            path = self._driver_dirs.pop(id(driver), None)
+        if path:
+            self._drop_clone(path)
+
+    def _drop_clone(self, path):
+        with self._lock:
+            if path in self.clones:
+                self.clones.remove(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+    def cleanup(self):
+        with self._lock:
+            clones, self.clones = self.clones, []
+        for path in clones:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+# ---------------- RESOURCE FILTER ---------------- #
+# Third-party trackers, ads, social widgets and media. TradingView's own hosts
+# (static, data, widget and websocket) stay reachable for the chart and legend.
+DEFAULT_BLOCK_URLS = [
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*",
+    "*googlesyndication.com*", "*googleadservices.com*", "*adservice.google.*",
+    "*connect.facebook.net*", "*facebook.com/tr*", "*platform.twitter.com*",
+    "*static.ads-twitter.com*", "*snap.licdn.com*", "*hotjar.com*", "*amplitude.com*",
+    "*sentry.io*", "*criteo.*", "*taboola.com*", "*outbrain.com*", "*scorecardresearch.com*",
+    "*.mp4*", "*.webm*", "*.mp3*",
+]
+
+def block_urls_from_env(value):
+    """
+    BLOCK_URLS: unset/"" = defaults, "none" = no blocking,
+    "+a,b" = defaults plus a and b, "a,b" = exactly a and b.
+    """
+    value = (value or "").strip()
+    if not value:
+        return list(DEFAULT_BLOCK_URLS)
+    if value.lower() in ("none", "off", "0"):
+        return []
+    extra = [p.strip() for p in value.lstrip("+").split(",") if p.strip()]
+    return DEFAULT_BLOCK_URLS + extra if value.startswith("+") else extra
+
+def install_resource_filter(driver, patterns):
+    """
+    Blocks matching requests for this driver via CDP, and enlarges the resource
+    timing buffer so page_traffic() sees every request. Returns False if CDP is unavailable.
+    """
+    try:
+        driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument",
+                               {"source": "performance.setResourceTimingBufferSize(5000);"})
+        if patterns:
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(patterns)})
+        return True
+    except Exception:
+        return False
+
+# transferSize is 0 for cached responses and for cross-origin ones without Timing-Allow-Origin
+PAGE_TRAFFIC_JS = """
+const es = performance.getEntriesByType('navigation').concat(performance.getEntriesByType('resource'));
+let bytes = 0;
+for (const e of es) bytes += e.transferSize || 0;
+return JSON.stringify([es.length, bytes]);
+"""
+
+def page_traffic(driver):
+    """(requests, bytes transferred) for the document currently loaded."""
+    try:
+        n, b = json.loads(driver.execute_script(PAGE_TRAFFIC_JS))
+        return int(n), int(b)
+    except Exception:
+        return 0, 0
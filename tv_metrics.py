@@ -0,0 +1,168 @@
+"""
+Per-stage timing for run_scraper.py and nextbagger-review.py.
+
+    rec = metrics.record(symbol, row=i)
+    with rec.stage("page_load"):
+        driver.get(url)
+    metrics.emit(rec, status="ok")     # one JSON line per symbol in METRICS_FILE
+
+    metrics.observe("sheet_write", secs)  # stages that aren't per symbol (batched writes)
+    metrics.count("pages")
+
+At the end of a run summary_lines() gives p50/p95/p99 per stage and
+write_prometheus() writes a node_exporter textfile. Recording a stage is a
+perf_counter pair and a list append, cheap enough to leave on.
+"""
+import os, json, time, threading
+from collections import Counter
+from contextlib import contextmanager
+
+
+def percentile(sorted_vals, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+
+class Record:
+    """Stage durations and extra fields of one symbol; not shared between threads."""
+
+    def __init__(self, symbol, **fields):
+        self.symbol = symbol
+        self.fields = fields
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def add(self, name, seconds):
+        # a stage repeated within one symbol (e.g. several timeframes) is summed
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+
+class Metrics:
+    def __init__(self, job, jsonl_path="", prom_path="", log=print):
+        self.job = job
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.log = log
+        self.samples = {}  # stage -> [seconds]
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._out = None
+        if jsonl_path:
+            try:
+                self._out = open(jsonl_path, "a", buffering=1)
+            except OSError as e:
+                log(f"⚠️ Metrics file not writable ({e}), JSON lines disabled")
+
+    def record(self, symbol, **fields):
+        return Record(symbol, **fields)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    @contextmanager
+    def timed(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def emit(self, rec, **fields):
+        """Folds the record into the histograms and writes it as one JSON line."""
+        total = time.perf_counter() - rec.started
+        line = {"ts": round(time.time(), 3), "job": self.job, "symbol": rec.symbol}
+        line.update(rec.fields)
+        line.update(fields)
+        line["stages"] = {k: round(v, 4) for k, v in rec.stages.items()}
+        line["total"] = round(total, 4)
+        with self._lock:
+            for k, v in rec.stages.items():
+                self.samples.setdefault(k, []).append(v)
+            self.samples.setdefault("symbol_total", []).append(total)
+            if self._out:
+                try:
+                    self._out.write(json.dumps(line) + "\n")
+                except (OSError, ValueError):
+                    pass
+
+    def merge(self, samples, counters):
+        """Adds the samples and counters of another Metrics (e.g. a worker process) to this one."""
+        with self._lock:
+            for stage, vals in samples.items():
+                self.samples.setdefault(stage, []).extend(vals)
+            self.counters.update(counters)
+
+    def snapshot(self):
+        """(samples, counters) as plain picklable data, for merge() elsewhere."""
+        with self._lock:
+            return {k: list(v) for k, v in self.samples.items()}, dict(self.counters)
+
+    def stats(self, stage):
+        """(n, p50, p95, p99, max, sum) for one stage, None if never observed."""
+        with self._lock:
+            vals = sorted(self.samples.get(stage, ()))
+        if not vals:
+            return None
+        return (len(vals), percentile(vals, 0.5), percentile(vals, 0.95), percentile(vals, 0.99),
+                vals[-1], sum(vals))
+
+    def summary_lines(self):
+        with self._lock:
+            stages = sorted(self.samples)
+        out = []
+        for stage in stages:
+            n, p50, p95, p99, mx, _ = self.stats(stage)
+            out.append(f"{stage:<16} n={n:<5} p50={p50:.2f}s p95={p95:.2f}s p99={p99:.2f}s max={mx:.2f}s")
+        return out
+
+    def write_prometheus(self):
+        """Atomically writes all stages and counters in the Prometheus text format."""
+        if not self.prom_path:
+            return
+        with self._lock:
+            stages = sorted(self.samples)
+            counters = dict(self.counters)
+        lines = ["# HELP tv_stage_seconds Scraper stage durations.", "# TYPE tv_stage_seconds summary"]
+        for stage in stages:
+            n, p50, p95, p99, _, total = self.stats(stage)
+            lbl = f'job="{self.job}",stage="{stage}"'
+            for q, v in (("0.5", p50), ("0.95", p95), ("0.99", p99)):
+                lines.append(f'tv_stage_seconds{{{lbl},quantile="{q}"}} {v:.6f}')
+            lines.append(f"tv_stage_seconds_sum{{{lbl}}} {total:.6f}")
+            lines.append(f"tv_stage_seconds_count{{{lbl}}} {n}")
+        lines += ["# HELP tv_events_total Scraper event counters.", "# TYPE tv_events_total counter"]
+        for name in sorted(counters):
+            lines.append(f'tv_events_total{{job="{self.job}",name="{name}"}} {counters[name]}')
+        lines.append(f'tv_last_run_timestamp_seconds{{job="{self.job}"}} {time.time():.0f}')
+        tmp = f"{self.prom_path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp, self.prom_path)
+        except OSError as e:
+            self.log(f"⚠️ Prometheus textfile not written: {e}")
+
+    def close(self):
+        self.write_prometheus()
+        with self._lock:
+            if self._out:
+                try:
+                    self._out.close()
+                except OSError:
+                    pass
+                self._out = None